@@ -0,0 +1,241 @@
+########################################################################
+# About this script
+
+# Benchmarks for lib_pipeline_tauimages_getstats.
+#
+# This script generates a synthetic screen, i.e. two-channel 16-bit tif
+# files like the ones exported by LAS-X (intensity in CHANNEL_INT, mean
+# arrival times in CHANNEL_TAU, encoded with CONVERSION_FACTOR), together
+# with a matching metadata excel file. It then times each step of the
+# pipeline, and reports the throughput (images/s and MB/s) and peak
+# memory use (as seen by tracemalloc, so memory used by worker processes
+# is not included). As tracemalloc slows down the code, the peak memory 
+# is measured in a separate run of each step.
+#
+# Run it from the command line, e.g.:
+#   python dev/benchmark_pipeline.py --workdir /tmp/taustats_benchmark --nr-wells 96 --image-size 1024
+# or run the functions below line by line.
+
+########################################################################
+# Libraries
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+import matplotlib
+matplotlib.use('Agg') # no windows should pop up during benchmarking
+
+LIBSCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(LIBSCRIPT_DIR)
+import lib_pipeline_tauimages_getstats as taustats
+
+########################################################################
+# Synthetic data
+
+def generate_synthetic_dataset(path_workdir, nr_wells=24, image_size=512, mean_intensity=100,
+                               noise_tau=0.5, tau_range=(3.0, 4.5), compression=None, seed=0):
+    # Generate a synthetic screen in path_workdir/data, and a metadata file
+    # path_workdir/SampleList.xlsx. Returns the path to the metadata file.
+    #
+    # nr_wells:       number of samples; each sample has two conditions (two images)
+    # image_size:     images are image_size x image_size pixels
+    # mean_intensity: average photon count per pixel (Poisson distributed)
+    # noise_tau:      standard deviation (ns) of the arrival time of a pixel with
+    #                 mean_intensity photons; pixels with fewer photons are noisier
+    # tau_range:      range (ns) from which the true lifetimes of the samples are drawn
+    # compression:    None, or a compression supported by tifffile (e.g. 'zlib')
+
+    rng = np.random.default_rng(seed)
+    path_datadir = path_workdir + '/data'
+    condition_names = ['No reagent', 'With reagent']
+
+    metadata_rows = []
+    for well_idx in range(nr_wells):
+
+        sample_name = chr(ord('A') + (well_idx // 12) % 26) + str(well_idx % 12 + 1)
+        tau_sample = rng.uniform(*tau_range)
+
+        for condition_int in [0, 1]:
+
+            subdir = 'condition_' + str(condition_int)
+            os.makedirs(path_datadir + '/' + subdir, exist_ok=True)
+            filename = 'file_' + sample_name + '_' + str(condition_int)
+
+            # The reagent changes both lifetime and intensity a bit
+            tau_true = tau_sample + condition_int * rng.normal(0.2, 0.1)
+            intensity_true = mean_intensity * (1 + condition_int * rng.normal(0.3, 0.1))
+
+            img_int = rng.poisson(intensity_true, size=(image_size, image_size))
+            sd_tau = noise_tau * np.sqrt(mean_intensity / np.maximum(img_int, 1))
+            img_tau = rng.normal(tau_true, sd_tau) * taustats.CONVERSION_FACTOR
+
+            my_img = np.zeros((2, image_size, image_size), dtype=np.uint16)
+            my_img[taustats.CHANNEL_INT] = np.clip(img_int, 0, 2**16-1)
+            my_img[taustats.CHANNEL_TAU] = np.clip(img_tau, 0, 2**16-1)
+            tifffile.imwrite(path_datadir + '/' + subdir + '/' + filename + '.tif', my_img, compression=compression)
+
+            metadata_rows.append({'Analysis_ID': 'benchmark' if len(metadata_rows) == 0 else None,
+                                  'Datadir': path_datadir, 'File': filename, 'Sample': sample_name,
+                                  'Condition': condition_names[condition_int], 'Condition_int': condition_int,
+                                  'subdir': subdir})
+
+    path_sample_metadata = path_workdir + '/SampleList.xlsx'
+    pd.DataFrame(metadata_rows).to_excel(path_sample_metadata, index=False)
+
+    return path_sample_metadata
+
+########################################################################
+# Benchmarking
+
+def time_stage(stage_name, stage_function, nr_images=None, nr_bytes=None, measure_memory=True):
+    # Run stage_function, and return a dict with the time it took, the 
+    # peak memory use, and the throughput. The time is measured without 
+    # tracemalloc; if measure_memory is True, stage_function is run a 
+    # second time to measure the peak memory (otherwise, it is NaN).
+    # Returns (result of the timed run of stage_function, dict with measurements).
+
+    time_start = time.perf_counter()
+    result = stage_function()
+    duration = time.perf_counter() - time_start
+
+    peak_memory = np.nan
+    if measure_memory:
+        tracemalloc.start()
+        stage_function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    measurement = {'stage': stage_name, 'time_s': duration, 'peak_memory_MB': peak_memory / 1e6,
+                   'images_per_s': np.nan if nr_images is None else nr_images / duration,
+                   'MB_per_s': np.nan if nr_bytes is None else nr_bytes / 1e6 / duration}
+    print(f"{stage_name:<45s} {duration:8.3f} s  {measurement['images_per_s']:8.1f} images/s  "
+          f"{measurement['MB_per_s']:8.1f} MB/s  {measurement['peak_memory_MB']:8.1f} MB peak")
+
+    return result, measurement
+
+def get_dataset_size(df_sample_data):
+    # Number of images and total size of their files (bytes)
+    filepaths = df_sample_data['Datadir'] + '/' + df_sample_data['subdir'] + '/' + df_sample_data['File'] + '.tif'
+    return len(filepaths), sum(os.path.getsize(filepath) for filepath in filepaths)
+
+def run_benchmarks(path_workdir, n_workers=1, dorus_mean_intensities=(1000, 20000), **dataset_options):
+    # Generate a synthetic dataset in path_workdir, and time all steps of
+    # the pipeline. Returns a dataframe with the measurements, which is
+    # also saved as path_workdir/benchmark_results.csv.
+    # As the speed of the median filter of the dorus masking depends on the 
+    # range of intensities, it is also timed on datasets with the mean 
+    # intensities in dorus_mean_intensities.
+
+    path_sample_metadata = generate_synthetic_dataset(path_workdir, **dataset_options)
+    path_outputdir = path_workdir + '/output'
+
+    measurements = []
+
+    # Loading the metadata
+    (df_sample_metadata, df_sample_data), measurement = time_stage('initialize_analysis',
+        lambda: taustats.initialize_analysis(path_sample_metadata))
+    measurements.append(measurement)
+
+    # Extraction of the statistics (the images are read once beforehand,
+    # such that all variants have the file system cache on their side)
+    filepaths = df_sample_data['Datadir'] + '/' + df_sample_data['subdir'] + '/' + df_sample_data['File'] + '.tif'
+    nr_images, nr_bytes = get_dataset_size(df_sample_data)
+    for filepath in filepaths:
+        with open(filepath, 'rb') as file:
+            file.read()
+
+    # The masking imports skimage and scipy on first use; import them beforehand, 
+    # such that their import time is not included in the timings
+    import skimage.filters.rank, skimage.exposure, skimage.morphology, scipy.ndimage
+    
+    # (the batched extraction always runs in a single process)
+    extract_in_workers = lambda df, **options: taustats.extract_means_and_medians(df, n_workers=n_workers, **options)
+    extraction_variants = {'extract_means_and_medians (numpy)': (extract_in_workers, {'reducer': 'numpy'}),
+                           'extract_means_and_medians (histogram)': (extract_in_workers, {}),
+                           'extract_means_and_medians (streaming)': (extract_in_workers, {'streaming': True}),
+                           'extract_means_and_medians (dorus masking)': (extract_in_workers, {'masking': 'dorus'}),
+                           'extract_means_and_medians_batched': (taustats.extract_means_and_medians_batched, {}),
+                           'extract_means_and_medians_batched (dorus masking)': (taustats.extract_means_and_medians_batched, {'masking': 'dorus'})}
+    for stage_name, (extraction_function, extraction_options) in extraction_variants.items():
+        _, measurement = time_stage(stage_name,
+            lambda: extraction_function(df_sample_data.copy(), **extraction_options),
+            nr_images=nr_images, nr_bytes=nr_bytes)
+        measurements.append(measurement)
+
+    # Dorus masking at higher intensities
+    for mean_intensity in dorus_mean_intensities:
+        path_sample_metadata_dorus = generate_synthetic_dataset(path_workdir + '/dorus_intensity_' + str(mean_intensity), 
+            **dict(dataset_options, mean_intensity=mean_intensity))
+        _, df_sample_data_dorus = taustats.initialize_analysis(path_sample_metadata_dorus)
+        nr_images_dorus, nr_bytes_dorus = get_dataset_size(df_sample_data_dorus)
+        _, measurement = time_stage('extract_means_and_medians (dorus masking, intensity ' + str(mean_intensity) + ')',
+            lambda: taustats.extract_means_and_medians(df_sample_data_dorus.copy(), n_workers=n_workers, masking='dorus'),
+            nr_images=nr_images_dorus, nr_bytes=nr_bytes_dorus)
+        measurements.append(measurement)
+    
+    # The remaining steps use the regular (histogram) outcome
+    df_sample_data = taustats.extract_means_and_medians(df_sample_data, n_workers=n_workers)
+
+    df_sample_data, measurement = time_stage('calculate_differences',
+        lambda: taustats.calculate_differences(df_sample_data.copy()))
+    measurements.append(measurement)
+
+    _, measurement = time_stage('save_dataframe_to_excel',
+        lambda: taustats.save_dataframe_to_excel(df_sample_data, path_outputdir))
+    measurements.append(measurement)
+
+    _, measurement = time_stage('load_dataframe_from_excel',
+        lambda: taustats.load_dataframe_from_excel(path_outputdir, 'benchmark'))
+    measurements.append(measurement)
+
+    _, measurement = time_stage('save_dataframe (parquet only)',
+        lambda: taustats.save_dataframe(df_sample_data, path_outputdir, excel=False))
+    measurements.append(measurement)
+
+    _, measurement = time_stage('load_dataframe (parquet)',
+        lambda: taustats.load_dataframe(path_outputdir, 'benchmark'))
+    measurements.append(measurement)
+
+    # The plotting functions are loaded on first use (with matplotlib and seaborn); 
+    # load them beforehand, such that their import time is not included in the timings
+    import lib_pipeline_tauimages_plots
+    
+    # Plotting (force=True, such that plots that are up to date from a previous run are made anyway)
+    plot_calls = {'plot_differences_lines': lambda: taustats.plot_differences_lines(df_sample_data, path_outputdir, force=True),
+                  'plot_differences_lines_fancylabels': lambda: taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, force=True),
+                  'plot_differences_bars': lambda: taustats.plot_differences_bars(df_sample_data, path_outputdir, force=True),
+                  'scatterplot_diff_intensity_diff_arrival': lambda: taustats.scatterplot_diff_intensity_diff_arrival(df_sample_data, path_outputdir, force=True)}
+    for stage_name, plot_call in plot_calls.items():
+        _, measurement = time_stage(stage_name, plot_call)
+        measurements.append(measurement)
+
+    df_measurements = pd.DataFrame(measurements)
+    df_measurements.to_csv(path_workdir + '/benchmark_results.csv', index=False)
+
+    return df_measurements
+
+########################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the tau-from-uniformimage pipeline on synthetic data.')
+    parser.add_argument('--workdir', required=True, help='directory where synthetic data and results are written')
+    parser.add_argument('--nr-wells', type=int, default=24, help='number of samples (each has two images)')
+    parser.add_argument('--image-size', type=int, default=512, help='width and height of the images in pixels')
+    parser.add_argument('--mean-intensity', type=float, default=100, help='mean photon count per pixel')
+    parser.add_argument('--noise-tau', type=float, default=0.5, help='arrival time noise (ns) at the mean intensity')
+    parser.add_argument('--compression', default=None, help='tif compression, e.g. zlib (default: none)')
+    parser.add_argument('--dorus-intensities', type=float, nargs='*', default=[1000, 20000],
+                        help='mean photon counts at which the dorus masking is also timed')
+    parser.add_argument('--n-workers', type=int, default=1, help='number of processes for extract_means_and_medians')
+    args = parser.parse_args()
+
+    run_benchmarks(args.workdir, n_workers=args.n_workers, dorus_mean_intensities=args.dorus_intensities, nr_wells=args.nr_wells, image_size=args.image_size,
+                   mean_intensity=args.mean_intensity, noise_tau=args.noise_tau, compression=args.compression)
@@ -0,0 +1,70 @@
+########################################################################
+# About this script
+
+# Checks that place_labels (lib_pipeline_tauimages_plots) leaves no
+# overlapping labels, for the layout of plot_differences_lines_fancylabels,
+# where all labels are at the same x (Condition_int = 1).
+#
+# Run it with pytest:
+#   python -m pytest dev/test_label_placement.py
+# or directly:
+#   python dev/test_label_placement.py
+
+########################################################################
+# Libraries
+
+import os
+import sys
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg') # no windows should pop up during testing
+import matplotlib.pyplot as plt
+
+LIBSCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(LIBSCRIPT_DIR)
+import lib_pipeline_tauimages_plots as tauplots
+
+########################################################################
+
+def count_overlapping_labels(texts, fig):
+    # Number of pairs of texts whose bounding boxes (in pixels) overlap
+    
+    renderer = fig.canvas.get_renderer()
+    extents = np.array([text.get_window_extent(renderer).extents for text in texts])
+    i, j = np.triu_indices(len(texts), k=1)
+    overlapping = ((extents[i, 0] < extents[j, 2]) & (extents[j, 0] < extents[i, 2]) & 
+                   (extents[i, 1] < extents[j, 3]) & (extents[j, 1] < extents[i, 3]))
+    
+    return int(np.sum(overlapping))
+
+def place_labels_at_single_x(nr_labels, seed=0):
+    # Make a figure like plot_differences_lines_fancylabels with nr_labels samples, 
+    # and return the number of overlapping labels
+    
+    rng = np.random.default_rng(seed)
+    values = rng.normal(3.5, 0.3, size=nr_labels)
+    sample_names = [chr(ord('A') + (idx // 12) % 26) + str(idx % 12 + 1) for idx in range(nr_labels)]
+    
+    fig, ax = plt.subplots(1,1,figsize=(10*tauplots.cm_to_inch,10*tauplots.cm_to_inch))
+    for value in values:
+        ax.plot([0, 1], [value + rng.normal(0, 0.1), value], marker='o', markersize=10)
+    ax.set_xlim(-0.5, 2.0)
+    plt.tight_layout()
+    texts = tauplots.place_labels(ax, np.ones(nr_labels), values, sample_names)
+    fig.canvas.draw()
+    nr_overlapping = count_overlapping_labels(texts, fig)
+    plt.close(fig)
+    
+    return nr_overlapping
+
+def test_no_overlapping_labels_at_single_x():
+    for nr_labels in [8, 16, 24, 32, 48, 64, 96]:
+        assert place_labels_at_single_x(nr_labels) == 0, str(nr_labels) + ' labels overlap'
+
+########################################################################
+
+if __name__ == '__main__':
+    for nr_labels in [8, 16, 24, 32, 48, 64, 96]:
+        print(nr_labels, 'labels:', place_labels_at_single_x(nr_labels), 'overlapping pairs')
@@ -19,6 +19,9 @@ if False:
     sys.path.append(LIBSCRIPT_DIR)
     import lib_pipeline_tauimages_getstats as imgstats
 
+# Version of this library (also used to determine whether plots are up to date)
+__version__ = '1.1'
+
 ########################################################################
 # Important script parameters
 
@@ -37,27 +40,41 @@ CONVERSION_FACTOR = 6553.6 # Conversion factor to convert the 16-bit image to na
 # Library (and thus dependencies)
 
 import pandas as pd
-from skimage import io as skio
+import tifffile
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-from adjustText import adjust_text
+# (skimage and scipy are only imported within the functions that need them, 
+# as they take relatively long to import)
 
 import os
+import json
+import time
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from functools import partial
+from statistics import NormalDist
+
+# The plotting functions are in lib_pipeline_tauimages_plots.py, such that 
+# matplotlib, seaborn and adjustText are only loaded when plots are made 
+# (this keeps e.g. worker processes lightweight). They can still be used 
+# as if they were part of this library, e.g. taustats.plot_differences_lines, 
+# as they are loaded on first use by __getattr__ below.
+
+PLOTTING_NAMES = ['plot_differences_lines', 'plot_differences_lines_fancylabels', 'plot_differences_bars',
+                  'scatterplot_diff_intensity_diff_arrival', 'render_all_plots', 'place_labels', 'cm_to_inch', 'color_palette']
 
-cm_to_inch = 1/2.54
+def __getattr__(name):
+    
+    if name in PLOTTING_NAMES:
+        import lib_pipeline_tauimages_plots
+        return getattr(lib_pipeline_tauimages_plots, name)
+    
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
 
-color_palette = [
-    "#E69F00",  # Orange
-    "#56B4E9",  # Sky Blue
-    "#009E73",  # Bluish Green
-    "#F0E442",  # Yellow
-    "#0072B2",  # Blue
-    "#D55E00",  # Vermillion
-    "#CC79A7",  # Reddish Purple
-    "#000000"   # Black
-] 
+def __dir__():
+    return list(globals()) + PLOTTING_NAMES
 
 ########################################################################
 
@@ -71,54 +88,1822 @@ def initialize_analysis(path_sample_metadata):
     
     return df_sample_metadata, df_sample_data
 
+########################################################################
+# Profiling
+#
+# To find out which step of an analysis takes most time, a run profile 
+# can be passed to extract_means_and_medians and the plotting functions 
+# (parameter profile). These then record per file the time spent on 
+# reading (read_s), decoding (decode_s) and calculating statistics 
+# (reduce_s) and the number of bytes read, and per plot the time 
+# spent on rendering. Other steps can be timed using profile_stage.
+# For example:
+#
+#   profile = new_run_profile()
+#   df_sample_data = extract_means_and_medians(df_sample_data, profile=profile)
+#   with profile_stage(profile, 'stage', 'calculate_differences'):
+#       df_sample_data = calculate_differences(df_sample_data)
+#   save_run_profile(profile, path_outputdir, analysis_ID)
+#
+# Note that measuring read and decode time separately requires reading
+# the data in memory, so memory-mapped files are loaded completely.
+
+def new_run_profile():
+    # A run profile is a dict with a list of entries (one dict per measurement)
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'entries': []}
+
+def record_profile_entry(profile, category, name, **measurements):
+    # Add a measurement to a run profile (nothing happens if profile is None)
+    
+    if profile is None:
+        return None
+    
+    entry = {'category': category, 'name': name}
+    entry.update(measurements)
+    profile['entries'].append(entry)
+    
+    return None
+
+@contextmanager
+def profile_stage(profile, category, name):
+    # Context manager that records the time spent within the with-block
+    
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_profile_entry(profile, category, name, time_s=time.perf_counter() - time_start)
+
+def save_run_profile(profile, path_outputdir, analysis_ID):
+    # Save the run profile as json, and as a table (csv) with one row per entry, in 
+    # output_<analysis_ID>/analysis_<analysis_ID>__run_profile.json/.csv
+    
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    os.makedirs(path_outputdir_plussubdir, exist_ok=True)
+    
+    with open(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__run_profile.json', 'w') as file:
+        json.dump(profile, file, indent=1)
+    pd.DataFrame(profile['entries']).to_csv(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__run_profile.csv', index=False)
+    
+    return None
+
+########################################################################
+# Reading images
+#
+# The LAS-X tifs hold one channel per page, of which we only need two.
+# Rather than decoding the whole file, uncompressed tifs are memory-mapped,
+# such that only the pixels of the requested channels are actually read 
+# from disk (and only when they are used). For compressed tifs, only the
+# pages of the requested channels are decoded. Only when the layout of the
+# file is not recognized, the whole image is decoded using skimage.
+
+def read_channels(filepath, channels, timings=None):
+    # Read the channels with indices given in the list channels from a tif file.
+    # Returns a list with one 2D array per requested channel.
+    # If a dict is given as timings, the time spent reading and decoding 
+    # (read_s, decode_s) and the number of bytes read (bytes_read) are stored in it.
+    
+    time_start = time.perf_counter()
+    
+    # Uncompressed, contiguous data can be memory-mapped
+    try:
+        my_img = tifffile.memmap(filepath, mode='r')
+    except ValueError:
+        my_img = None
+    if my_img is not None and my_img.ndim == 3:
+        channel_imgs = [my_img[channel,:,:] for channel in channels]
+        if timings is not None:
+            # there's no decoding; reading happens when the pixels are accessed
+            channel_imgs = [np.array(channel_img) for channel_img in channel_imgs]
+            timings.update({'read_s': time.perf_counter() - time_start, 'decode_s': 0.0, 
+                            'bytes_read': sum(channel_img.nbytes for channel_img in channel_imgs)})
+        return channel_imgs
+    
+    # Otherwise, decode only the pages of interest, if each page holds one channel
+    with tifffile.TiffFile(filepath) as tif:
+        series_shape = tif.series[0].shape
+        if len(series_shape) == 3 and len(tif.pages) == series_shape[0] and tif.pages[0].ndim == 2:
+            
+            if timings is not None:
+                # read the raw (compressed) data separately, to distinguish reading from decoding
+                bytes_read = 0
+                for channel in channels:
+                    for offset, bytecount in zip(tif.pages[channel].dataoffsets, tif.pages[channel].databytecounts):
+                        tif.filehandle.seek(offset)
+                        bytes_read += len(tif.filehandle.read(bytecount))
+                time_read = time.perf_counter()
+            
+            channel_imgs = [tif.pages[channel].asarray() for channel in channels]
+            
+            if timings is not None:
+                timings.update({'read_s': time_read - time_start, 'decode_s': time.perf_counter() - time_read, 
+                                'bytes_read': bytes_read})
+            return channel_imgs
+    
+    # Fall back to decoding the full image
+    from skimage import io as skio
+    if timings is not None:
+        with open(filepath, 'rb') as file:
+            bytes_read = len(file.read())
+        time_read = time.perf_counter()
+    my_img = skio.imread(filepath)
+    if timings is not None:
+        timings.update({'read_s': time_read - time_start, 'decode_s': time.perf_counter() - time_read, 
+                        'bytes_read': bytes_read})
+    return [my_img[channel,:,:] for channel in channels]
+
+# Reading ahead
+#
+# When the images are on a network share, reading a file takes long, 
+# and the processor waits for the network while reading, and vice versa 
+# while the statistics are calculated. prefetch_channels therefore reads 
+# the next files in background threads while the current file is being 
+# processed. At most depth files are read ahead, and reading ahead pauses
+# when the files that were read ahead (but not yet processed) take more 
+# than max_bytes of memory (at least one file is always read ahead).
+
+PREFETCH_DEPTH = 4
+PREFETCH_MAX_BYTES = 2**30 # 1 GB
+
+def _read_channels_in_memory(filepath, channels, timings=False):
+    # read_channels, but such that the pixels are actually in memory 
+    # (also for memory-mapped files); returns (channel images, timings).
+    # Timings are only determined if timings is True, as measuring them 
+    # reads compressed files twice (see read_channels).
+    
+    if timings:
+        timings = {}
+        return read_channels(filepath, channels, timings=timings), timings
+    
+    channel_imgs = [np.array(channel_img) if isinstance(channel_img, np.memmap) else channel_img
+                    for channel_img in read_channels(filepath, channels)]
+    return channel_imgs, {}
+
+def prefetch_channels(filepaths, channels, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_BYTES, timings=False):
+    # Generator that reads the given channels of the files in filepaths, 
+    # reading up to depth files ahead in background threads.
+    # Yields (filepath, result) in the order of filepaths, where result is 
+    # (channel images, timings) as from read_channels, or the exception 
+    # that occurred while reading the file. The timings are only determined
+    # if timings is True (otherwise, they are an empty dict).
+    
+    executor = ThreadPoolExecutor(max_workers=depth)
+    pending = deque() # (filepath, future, expected nr of bytes)
+    state = {'idx_next': 0, 'bytes_pending': 0, 'bytes_per_file': None}
+    
+    def read_ahead():
+        while state['idx_next'] < len(filepaths) and len(pending) < depth:
+            filepath = filepaths[state['idx_next']]
+            # expected memory use: that of the largest file so far (or, initially, the file size)
+            expected_bytes = state['bytes_per_file']
+            if expected_bytes is None:
+                expected_bytes = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+            if len(pending) > 0 and state['bytes_pending'] + expected_bytes > max_bytes:
+                break
+            pending.append((filepath, executor.submit(_read_channels_in_memory, filepath, channels, timings), expected_bytes))
+            state['bytes_pending'] += expected_bytes
+            state['idx_next'] += 1
+    
+    try:
+        read_ahead()
+        while len(pending) > 0:
+            
+            filepath, future, expected_bytes = pending.popleft()
+            try:
+                result = future.result()
+                nr_bytes = sum(channel_img.nbytes for channel_img in result[0])
+                state['bytes_per_file'] = max(nr_bytes, state['bytes_per_file'] or 0)
+            except Exception as error:
+                result = error
+            state['bytes_pending'] -= expected_bytes
+            
+            # continue reading while the caller processes this file
+            read_ahead()
+            yield filepath, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# For tile scans that are too large to fit in memory, the pixels of a 
+# channel can also be read block by block. For uncompressed tifs, blocks
+# of STREAMING_BLOCK_ROWS rows are read directly from the file; for 
+# compressed tifs, the strips or tiles are decoded one at a time.
+
+STREAMING_BLOCK_ROWS = 256
+
+def iter_channel_blocks(filepath, channel, block_rows=STREAMING_BLOCK_ROWS):
+    # Yields the pixels of one channel as a series of 2D arrays, such that 
+    # at most one block is held in memory at a time.
+    
+    with tifffile.TiffFile(filepath) as tif:
+        
+        series = tif.series[0]
+        if len(series.shape) != 3:
+            raise ValueError('Expected an image with shape (channels, rows, columns), got ' + str(series.shape))
+        nr_rows, nr_cols = series.shape[1:]
+        
+        # Uncompressed, contiguous data: read blocks of rows from the file
+        if series.dataoffset is not None:
+            pixel_dtype = np.dtype(tif.byteorder + series.dtype.char)
+            channel_offset = series.dataoffset + channel * nr_rows * nr_cols * pixel_dtype.itemsize
+            for row in range(0, nr_rows, block_rows):
+                block_nr_rows = min(block_rows, nr_rows - row)
+                tif.filehandle.seek(channel_offset + row * nr_cols * pixel_dtype.itemsize)
+                yield tif.filehandle.read_array(pixel_dtype, count=block_nr_rows * nr_cols).reshape(block_nr_rows, nr_cols)
+            return
+        
+        # Compressed data: decode the strips or tiles of the page of this channel one by one
+        if len(tif.pages) != series.shape[0] or tif.pages[0].ndim != 2:
+            raise ValueError('Streaming requires one channel per page for compressed files')
+        page = tif.pages[channel]
+        for segment, indices, _ in page.segments():
+            # segments have shape (1, rows, columns, 1); tiles at the image border 
+            # are padded, so these are cropped
+            segment_nr_rows = min(segment.shape[1], page.imagelength - indices[-3])
+            segment_nr_cols = min(segment.shape[2], page.imagewidth - indices[-2])
+            yield segment[0, :segment_nr_rows, :segment_nr_cols, 0]
+
+# For a quick preview, only every stride-th pixel of every stride-th row 
+# is needed. For uncompressed tifs, only the file pages holding those rows 
+# are read (via the memory map); for compressed tifs, only the strips or
+# tiles that hold those rows are read and decoded (which saves time when 
+# the strips are shorter than stride rows).
+
+def _decode_page_subsampled(tif, page, stride):
+    # Decode every stride-th pixel of every stride-th row of a page
+    
+    nr_rows, nr_cols = page.imagelength, page.imagewidth
+    subsampled = np.empty((-(-nr_rows // stride), -(-nr_cols // stride)), dtype=page.dtype)
+    
+    if page.is_tiled:
+        segment_nr_rows, segments_across = page.tilelength, -(-nr_cols // page.tilewidth)
+    else:
+        segment_nr_rows, segments_across = page.rowsperstrip, 1
+    
+    for segment_index, (offset, bytecount) in enumerate(zip(page.dataoffsets, page.databytecounts)):
+        
+        # skip segments without rows of interest
+        row_start = (segment_index // segments_across) * segment_nr_rows
+        row_first = -(-row_start // stride) * stride
+        if row_first >= min(row_start + segment_nr_rows, nr_rows):
+            continue
+        
+        tif.filehandle.seek(offset)
+        segment, indices, _ = page.decode(tif.filehandle.read(bytecount), segment_index, jpegtables=page.jpegtables)
+        row_start, col_start = indices[-3], indices[-2]
+        segment = segment[0, :min(segment.shape[1], nr_rows - row_start), :min(segment.shape[2], nr_cols - col_start), 0]
+        
+        row_first = -(-row_start // stride) * stride
+        col_first = -(-col_start // stride) * stride
+        segment_subsampled = segment[row_first - row_start::stride, col_first - col_start::stride]
+        subsampled[row_first // stride:row_first // stride + segment_subsampled.shape[0], 
+                   col_first // stride:col_first // stride + segment_subsampled.shape[1]] = segment_subsampled
+    
+    return subsampled
+
+def read_channels_subsampled(filepath, channels, stride):
+    # Like read_channels, but returns only every stride-th pixel of every 
+    # stride-th row (i.e. channel_img[::stride, ::stride]) of each channel.
+    
+    # Uncompressed, contiguous data can be memory-mapped
+    try:
+        my_img = tifffile.memmap(filepath, mode='r')
+    except ValueError:
+        my_img = None
+    if my_img is not None and my_img.ndim == 3:
+        return [np.array(my_img[channel, ::stride, ::stride]) for channel in channels]
+    
+    # Otherwise, decode only the strips or tiles with rows of interest, if each page holds one channel
+    with tifffile.TiffFile(filepath) as tif:
+        series_shape = tif.series[0].shape
+        if len(series_shape) == 3 and len(tif.pages) == series_shape[0] and tif.pages[0].ndim == 2:
+            return [_decode_page_subsampled(tif, tif.pages[channel], stride) for channel in channels]
+    
+    # Fall back to reading the full channels
+    return [channel_img[::stride, ::stride] for channel_img in read_channels(filepath, channels)]
+
+# Per-image reducers
+#
+# LAS-X exports are 16-bit images, so instead of sorting all pixels 
+# (which is what np.median does), we can count how often each of the 
+# 2^16 possible values occurs in one pass (np.bincount). From that 
+# histogram, the mean, the median and any other quantile follow exactly.
+
+HISTOGRAM_CHUNKSIZE = 2**22 # number of pixels that are passed to np.bincount at once
+
+def histogram_from_channel(channel_img):
+    # Count the occurrences of each value in an unsigned integer (8/16-bit) image.
+    # Returns an array of length 2^bits, where counts[v] is the number of pixels with value v.
+    
+    pixel_values = channel_img.ravel()
+    nr_values = 2**(8*channel_img.dtype.itemsize)
+    
+    # np.bincount internally converts its input to 64-bit integers, so
+    # we feed it in chunks to keep that temporary copy small
+    counts = np.zeros(nr_values, dtype=np.int64)
+    for idx_start in range(0, pixel_values.size, HISTOGRAM_CHUNKSIZE):
+        counts += np.bincount(pixel_values[idx_start:idx_start+HISTOGRAM_CHUNKSIZE], minlength=nr_values)
+    
+    return counts
+
+def histogram_from_blocks(blocks):
+    # Histogram of all pixels in an iterable of image blocks (e.g. from iter_channel_blocks).
+    # Histograms can simply be added, so the result is identical to the 
+    # histogram of the full image.
+    
+    counts = None
+    for block in blocks:
+        if block.dtype not in [np.uint8, np.uint16]:
+            raise ValueError('Histograms can only be calculated for 8- or 16-bit unsigned images')
+        block_counts = histogram_from_channel(block)
+        counts = block_counts if counts is None else counts + block_counts
+    
+    return counts
+
+def mean_from_histogram(counts):
+    # Exact mean of the pixel values described by a histogram of counts.
+    
+    nr_pixels = counts.sum()
+    if nr_pixels == 0:
+        return np.nan
+    # the sum of counts*values is calculated with integers, so it is exact
+    return np.dot(counts, np.arange(len(counts), dtype=np.int64)) / nr_pixels
+
+def quantile_from_histogram(counts, q):
+    # Exact quantile q (0..1) of the pixel values described by a histogram of counts.
+    # Like np.quantile (and np.median for q=0.5), this interpolates linearly 
+    # between the two values closest to the requested position.
+    
+    nr_pixels = counts.sum()
+    if nr_pixels == 0:
+        return np.nan
+    cumulative_counts = np.cumsum(counts)
+    
+    # position of the quantile in the sorted list of pixel values
+    position = q * (nr_pixels - 1)
+    position_low = np.floor(position)
+    position_high = np.ceil(position)
+    
+    # the value at sorted position p is the first value for which the cumulative count exceeds p
+    value_low, value_high = np.searchsorted(cumulative_counts, [position_low, position_high], side='right')
+    
+    return value_low + (position - position_low) * (value_high - value_low)
+
+def median_from_histogram(counts):
+    # Exact median of the pixel values described by a histogram of counts.
+    return quantile_from_histogram(counts, 0.5)
+
+def channel_mean_and_median(channel_img, reducer='histogram'):
+    # Calculate the mean and median of a single channel.
+    #
+    # reducer: 'histogram' (default) uses a single bincount pass, and is 
+    #          used for 8- and 16-bit unsigned images; other image types 
+    #          automatically use the numpy functions.
+    #          'numpy' uses np.mean and np.median (the original approach).
+    
+    if reducer not in ['histogram', 'numpy']:
+        raise ValueError('reducer should be either "histogram" or "numpy"')
+    
+    if reducer == 'histogram' and channel_img.dtype in [np.uint8, np.uint16]:
+        counts = histogram_from_channel(channel_img)
+        return mean_from_histogram(counts), median_from_histogram(counts)
+    
+    return np.mean(channel_img), np.median(channel_img)
+
+# In preview mode (see extract_means_and_medians), the mean and median are 
+# estimated from a subsample of the pixels. The error bound is the half-width 
+# of the PREVIEW_CONFIDENCE interval around the estimate: for the mean, 
+# based on the standard error of the mean; for the median, based on the 
+# quantiles of the subsample that enclose the median with this confidence 
+# (which requires no assumptions about the distribution of the values). 
+# Both are corrected for the fraction of the image that was sampled.
+
+PREVIEW_STRIDE = 4
+PREVIEW_CONFIDENCE = 0.95
+
+def preview_mean_and_median(channel_subsample, sampled_fraction):
+    # Estimate the mean and median of an image from a subsample of its pixels.
+    # sampled_fraction: size of the subsample relative to the full image.
+    # Returns (mean, median, error bound of the mean, error bound of the median).
+    
+    nr_pixels = channel_subsample.size
+    if nr_pixels < 2:
+        return np.nan, np.nan, np.nan, np.nan
+    z_value = NormalDist().inv_cdf((1 + PREVIEW_CONFIDENCE) / 2)
+    finite_population_correction = np.sqrt(max(0.0, 1 - sampled_fraction))
+    
+    # quantiles that enclose the median with PREVIEW_CONFIDENCE
+    q_offset = min(0.5, z_value * 0.5 / np.sqrt(nr_pixels) * finite_population_correction)
+    
+    if channel_subsample.dtype in [np.uint8, np.uint16]:
+        counts = histogram_from_channel(channel_subsample)
+        mean, median = mean_from_histogram(counts), median_from_histogram(counts)
+        std = np.sqrt(np.dot(counts, (np.arange(len(counts)) - mean)**2) / (nr_pixels - 1))
+        median_low, median_high = quantile_from_histogram(counts, 0.5 - q_offset), quantile_from_histogram(counts, 0.5 + q_offset)
+    else:
+        mean, median, std = np.mean(channel_subsample), np.median(channel_subsample), np.std(channel_subsample, ddof=1)
+        median_low, median_high = np.quantile(channel_subsample, [0.5 - q_offset, 0.5 + q_offset])
+    
+    mean_error = z_value * std / np.sqrt(nr_pixels) * finite_population_correction
+    median_error = max(median - median_low, median_high - median)
+    
+    return mean, median, mean_error, median_error
+
+########################################################################
+# Intensity-masked arrival times, like the ImageJ plugin made by Dorus
+#
+# See dev/simple_example.py, where the plugin was reproduced step by step.
+# The plugin only considers pixels with sufficient intensity. To determine 
+# those, the intensity image is gamma-adjusted, median-filtered, and 
+# thresholded at 10% of its maximum. The mean arrival time is then 
+# calculated over the pixels within the mask.
+#
+# The functions below work on stacks of images (images, rows, columns), 
+# such that many images can be evaluated in one go. For images with a 
+# limited range of values (below DORUS_RANK_MAX_VALUE), the median filter 
+# is a histogram-based rank filter (skimage.filters.rank), which is much 
+# faster than a generic footprint filter; as its histograms span all 
+# values, it is slower for higher intensities, which therefore use 
+# scipy's median filter. Since gamma adjustment does not change the order 
+# of values, the median filter is applied before the gamma adjustment 
+# (with identical outcome), as the raw intensities span fewer values.
+
+DORUS_GAMMA = 0.7
+DORUS_MEDIAN_RADIUS = 3
+DORUS_THRESHOLD_FRACTION = 0.1
+DORUS_RANK_MAX_VALUE = 2**8 # the rank filter is only faster for images with values below this
+
+def dorus_intensity_masks(images_int, gamma=DORUS_GAMMA, median_radius=DORUS_MEDIAN_RADIUS, 
+                          threshold_fraction=DORUS_THRESHOLD_FRACTION):
+    # Determine the intensity masks for a single 2D intensity image, or a 3D 
+    # stack of intensity images (images, rows, columns).
+    
+    from skimage.filters import rank
+    from skimage.exposure import adjust_gamma
+    from skimage.morphology import disk
+    from scipy import ndimage as ndi
+    
+    stack_int = images_int if images_int.ndim == 3 else images_int[np.newaxis]
+    
+    # Median filter; the image is padded with its edge values, such that the 
+    # result is the same as skimage.filters.median (as used in dev/simple_example.py)
+    if median_radius > 0:
+        r = median_radius
+        stack_padded = np.pad(stack_int, ((0,0), (r,r), (r,r)), mode='edge')
+        if stack_int.dtype in [np.uint8, np.uint16] and stack_int.max() < DORUS_RANK_MAX_VALUE:
+            stack_filtered = rank.median(stack_padded.astype(np.uint8), footprint=disk(r)[np.newaxis])[:, r:-r, r:-r].astype(stack_int.dtype)
+        else:
+            stack_filtered = np.stack([ndi.median_filter(img, footprint=disk(r)) for img in stack_padded])[:, r:-r, r:-r]
+    else:
+        stack_filtered = stack_int
+    
+    # Gamma adjustment
+    stack_filtered = adjust_gamma(stack_filtered, gamma=gamma)
+    
+    # Automatic thresholds, at a fraction of the maximum of each image
+    thr_high = np.max(stack_filtered, axis=(1,2), keepdims=True)
+    thr_low = thr_high * threshold_fraction
+    masks = (stack_filtered > thr_low) & (stack_filtered < thr_high)
+    
+    return masks if images_int.ndim == 3 else masks[0]
+
+def histograms_from_stack(images, masks=None):
+    # Histograms of each image in a 3D stack of 8- or 16-bit images, optionally 
+    # only of the pixels within masks. Returns an array (images, 2^bits).
+    # All histograms are calculated in a single np.bincount call, by giving
+    # each image its own range of bins.
+    
+    nr_images = images.shape[0]
+    nr_values = 2**(8*images.dtype.itemsize)
+    
+    image_offsets = (np.arange(nr_images, dtype=np.int64) * nr_values)[:, np.newaxis, np.newaxis]
+    if masks is None:
+        binned_values = (images + image_offsets).ravel()
+    else:
+        binned_values = (images + image_offsets)[masks]
+    
+    return np.bincount(binned_values, minlength=nr_images*nr_values).reshape(nr_images, nr_values)
+
+def dorus_masked_arrival(images_tau, images_int, masks=None, **mask_options):
+    # Mean and median arrival times (in ns) within the intensity mask, for a 
+    # 3D stack of images, plus the fraction of pixels that are within the mask.
+    # mask_options are passed on to dorus_intensity_masks (unless the masks
+    # were already determined, and are given as masks).
+    # Returns three arrays with one value per image.
+    
+    if masks is None:
+        masks = dorus_intensity_masks(images_int, **mask_options)
+    counts_tau = histograms_from_stack(images_tau, masks)
+    
+    mean_tau = np.array([mean_from_histogram(counts) for counts in counts_tau]) / CONVERSION_FACTOR
+    median_tau = np.array([median_from_histogram(counts) for counts in counts_tau]) / CONVERSION_FACTOR
+    mask_fraction = np.mean(masks, axis=(1,2))
+    
+    return mean_tau, median_tau, mask_fraction
+
+########################################################################
+# Joint histograms of intensity and arrival time
+#
+# To choose intensity thresholds (like thr_low and thr_high in 
+# dev/simple_example.py), one would like to calculate the masked arrival
+# times for many thresholds. Rather than re-reading all images for each 
+# threshold, a joint 2D histogram (intensity x arrival time) is stored per
+# image during extract_means_and_medians. Masked mean and median arrival 
+# times then follow directly from the histograms, for any threshold pair.
+#
+# To keep the histograms compact, arrival times are binned in 
+# JOINT_HISTOGRAM_TAU_BINS bins (for 16-bit images, 128 values or 0.02 ns
+# per bin), and intensities in at most JOINT_HISTOGRAM_INT_BINS bins. For 
+# images with a maximum intensity below JOINT_HISTOGRAM_INT_BINS, each 
+# intensity value has its own bin, and thresholds are applied exactly; 
+# otherwise, only intensity bins that are completely within the thresholds 
+# are used. The sum of arrival times is also stored per intensity bin, such 
+# that masked means are exact; masked medians have the resolution of the 
+# arrival time bins.
+#
+# Most of the intensity x arrival time bins of an image are empty, so only
+# the non-empty bins are kept in memory and saved (see _sparse_joint_histogram);
+# masked_arrival_from_joint_histograms fills in the full histograms of 
+# JOINT_HISTOGRAM_CHUNK images at a time.
+
+JOINT_HISTOGRAM_TAU_BINS = 512
+JOINT_HISTOGRAM_INT_BINS = 512
+JOINT_HISTOGRAM_CHUNK = 64
+
+def joint_histogram(img_int, img_tau, int_bin_width=None):
+    # Calculate the joint histogram of an intensity and arrival time image.
+    # Returns a dict with:
+    #   counts:        (JOINT_HISTOGRAM_INT_BINS, JOINT_HISTOGRAM_TAU_BINS) array of pixel counts
+    #   tau_sums:      sum of the (raw) arrival time values per intensity bin
+    #   int_bin_width: intensity values per intensity bin
+    #   tau_bin_width: arrival time values per arrival time bin
+    
+    if int_bin_width is None:
+        int_bin_width = max(1, int(np.ceil((int(np.max(img_int)) + 1) / JOINT_HISTOGRAM_INT_BINS)))
+    tau_bin_width = 2**(8*img_tau.dtype.itemsize) // JOINT_HISTOGRAM_TAU_BINS
+    
+    int_bins = np.minimum(img_int.ravel() // int_bin_width, JOINT_HISTOGRAM_INT_BINS - 1).astype(np.int64)
+    tau_bins = (img_tau.ravel() // tau_bin_width).astype(np.int64)
+    
+    counts = np.bincount(int_bins * JOINT_HISTOGRAM_TAU_BINS + tau_bins, 
+                         minlength=JOINT_HISTOGRAM_INT_BINS*JOINT_HISTOGRAM_TAU_BINS)
+    tau_sums = np.bincount(int_bins, weights=img_tau.ravel(), minlength=JOINT_HISTOGRAM_INT_BINS)
+    
+    return {'counts': counts.reshape(JOINT_HISTOGRAM_INT_BINS, JOINT_HISTOGRAM_TAU_BINS).astype(np.int32),
+            'tau_sums': tau_sums, 'int_bin_width': int_bin_width, 'tau_bin_width': tau_bin_width}
+
+def _sparse_joint_histogram(hist):
+    # Keep only the non-empty bins of a joint histogram (see joint_histogram):
+    # the counts are replaced by count_indices (flat index of the bin) and count_values
+    
+    counts = hist['counts'].ravel()
+    count_indices = np.flatnonzero(counts).astype(np.int32)
+    
+    return {'count_indices': count_indices, 'count_values': counts[count_indices].astype(np.int32),
+            'tau_sums': hist['tau_sums'], 'int_bin_width': hist['int_bin_width'], 'tau_bin_width': hist['tau_bin_width']}
+
+def _dense_joint_counts(joint_histograms, idx_start, idx_end):
+    # Full counts (images, intensity bins, arrival time bins) of images idx_start..idx_end-1 
+    # of the joint histograms loaded by load_joint_histograms
+    
+    offsets = joint_histograms['count_offsets']
+    counts = np.zeros((idx_end - idx_start, JOINT_HISTOGRAM_INT_BINS * JOINT_HISTOGRAM_TAU_BINS), dtype=np.int32)
+    for idx in range(idx_start, idx_end):
+        counts[idx - idx_start, joint_histograms['count_indices'][offsets[idx]:offsets[idx+1]]] = \
+            joint_histograms['count_values'][offsets[idx]:offsets[idx+1]]
+    
+    return counts.reshape(-1, JOINT_HISTOGRAM_INT_BINS, JOINT_HISTOGRAM_TAU_BINS)
+
+def _quantile_from_histograms(counts, q):
+    # Like quantile_from_histogram, but for an array of histograms along the last axis
+    
+    nr_pixels = counts.sum(axis=-1)
+    cumulative_counts = np.cumsum(counts, axis=-1)
+    
+    position = q * (nr_pixels - 1)
+    position_low = np.floor(position)[..., np.newaxis]
+    position_high = np.ceil(position)[..., np.newaxis]
+    value_low = np.sum(cumulative_counts <= position_low, axis=-1)
+    value_high = np.sum(cumulative_counts <= position_high, axis=-1)
+    
+    quantiles = value_low + (position - position_low[..., 0]) * (value_high - value_low)
+    
+    return np.where(nr_pixels > 0, quantiles, np.nan)
+
+def save_joint_histograms(joint_histograms, df_sample_data, path_outputdir):
+    # Save the joint histograms (list with one dict or None per row of df_sample_data,
+    # as from _sparse_joint_histogram) in output_<analysis_ID>/analysis_<analysis_ID>__joint_histograms.npz
+    # The non-empty bins of all images are stored one after the other; those of 
+    # image i are count_indices/count_values[count_offsets[i]:count_offsets[i+1]].
+    
+    analysis_ID = df_sample_data['Analysis_ID'].iloc[0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    os.makedirs(path_outputdir_plussubdir, exist_ok=True)
+    
+    # Missing images get empty histograms, with a bin width of 0
+    empty_histogram = {'count_indices': np.zeros(0, dtype=np.int32), 'count_values': np.zeros(0, dtype=np.int32),
+                       'tau_sums': np.zeros(JOINT_HISTOGRAM_INT_BINS), 'int_bin_width': 0, 'tau_bin_width': 0}
+    joint_histograms = [empty_histogram if hist is None else hist for hist in joint_histograms]
+    
+    np.savez_compressed(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__joint_histograms.npz',
+        count_indices = np.concatenate([hist['count_indices'] for hist in joint_histograms]),
+        count_values = np.concatenate([hist['count_values'] for hist in joint_histograms]),
+        count_offsets = np.cumsum([0] + [len(hist['count_indices']) for hist in joint_histograms]),
+        tau_sums = np.stack([hist['tau_sums'] for hist in joint_histograms]),
+        int_bin_width = np.array([hist['int_bin_width'] for hist in joint_histograms]),
+        tau_bin_width = np.array([hist['tau_bin_width'] for hist in joint_histograms]),
+        File = np.asarray(df_sample_data['File'], dtype=str),
+        Sample = np.asarray(df_sample_data['Sample'], dtype=str),
+        Condition_int = np.asarray(df_sample_data['Condition_int']))
+    
+    return None
+
+def load_joint_histograms(path_outputdir, analysis_ID):
+    # Load the joint histograms saved by extract_means_and_medians(..., joint_histograms=True)
+    
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    with np.load(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__joint_histograms.npz') as npz_file:
+        joint_histograms = {key: npz_file[key] for key in npz_file.files}
+    
+    return joint_histograms
+
+def masked_arrival_from_joint_histograms(joint_histograms, thresholds_low, thresholds_high):
+    # Calculate the mean and median arrival time (ns) of the pixels with 
+    # thr_low < intensity < thr_high, for all images and all threshold pairs
+    # (thresholds_low[i], thresholds_high[i]). Single numbers can also be given.
+    # Returns a dataframe with one row per image and threshold pair.
+    #
+    # To sweep a grid of thresholds, use e.g.:
+    # thr_lows, thr_highs = np.meshgrid(np.arange(0,100,10), np.arange(200,500,50))
+    # masked_arrival_from_joint_histograms(joint_histograms, thr_lows.ravel(), thr_highs.ravel())
+    
+    thresholds_low = np.atleast_1d(thresholds_low)
+    thresholds_high = np.atleast_1d(thresholds_high)
+    
+    tau_sums = joint_histograms['tau_sums']   # (images, intensity bins)
+    all_int_bin_widths = np.maximum(joint_histograms['int_bin_width'], 1)[:, np.newaxis]
+    all_tau_bin_widths = joint_histograms['tau_bin_width'][:, np.newaxis]
+    
+    # The images are processed in chunks, to limit the memory used by the full histograms
+    results = {'nr_pixels': [], 'mean_tau': [], 'median_tau': []}
+    for idx_start in range(0, len(tau_sums), JOINT_HISTOGRAM_CHUNK):
+        
+        idx_end = min(idx_start + JOINT_HISTOGRAM_CHUNK, len(tau_sums))
+        counts = _dense_joint_counts(joint_histograms, idx_start, idx_end) # (images, intensity bins, arrival time bins)
+        int_bin_width = all_int_bin_widths[idx_start:idx_end]
+        tau_bin_width = all_tau_bin_widths[idx_start:idx_end]
+        
+        # Cumulative sums over intensity bins, such that the sum over any range 
+        # of intensity bins is a single subtraction
+        cumulative_counts = np.concatenate([np.zeros_like(counts[:, :1, :], dtype=np.int64), 
+                                            np.cumsum(counts, axis=1, dtype=np.int64)], axis=1)
+        cumulative_tau_sums = np.concatenate([np.zeros_like(tau_sums[idx_start:idx_end, :1]), 
+                                              np.cumsum(tau_sums[idx_start:idx_end], axis=1)], axis=1)
+        
+        # Determine the range of intensity bins that are completely within the thresholds,
+        # bin k holds intensities k*width .. (k+1)*width-1  (images, threshold pairs)
+        bin_first = np.clip(np.floor(thresholds_low[np.newaxis, :] / int_bin_width) + 1, 0, JOINT_HISTOGRAM_INT_BINS).astype(int)
+        bin_end = np.clip(np.ceil((thresholds_high[np.newaxis, :] - int_bin_width + 1) / int_bin_width), 0, JOINT_HISTOGRAM_INT_BINS).astype(int)
+        bin_end = np.maximum(bin_end, bin_first)
+        
+        idx_images = np.arange(counts.shape[0])[:, np.newaxis]
+        masked_counts = cumulative_counts[idx_images, bin_end] - cumulative_counts[idx_images, bin_first]
+        masked_tau_sums = cumulative_tau_sums[idx_images, bin_end] - cumulative_tau_sums[idx_images, bin_first]
+        nr_pixels = masked_counts.sum(axis=-1)
+        
+        # Mean (exact) and median (at the center of the arrival time bin)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['mean_tau'].append(masked_tau_sums / nr_pixels / CONVERSION_FACTOR)
+        median_bin = _quantile_from_histograms(masked_counts, 0.5)
+        results['median_tau'].append((median_bin * tau_bin_width + (tau_bin_width - 1) / 2) / CONVERSION_FACTOR)
+        results['nr_pixels'].append(nr_pixels)
+    
+    nr_pixels, mean_tau, median_tau = [np.concatenate(results[key]) if len(results[key]) > 0 else np.zeros((0, len(thresholds_low)))
+                                       for key in ['nr_pixels', 'mean_tau', 'median_tau']]
+    
+    # Collect everything in a dataframe
+    nr_images, nr_thresholds = nr_pixels.shape
+    df_masked = pd.DataFrame({
+        'File': np.repeat(joint_histograms['File'], nr_thresholds),
+        'Sample': np.repeat(joint_histograms['Sample'], nr_thresholds),
+        'Condition_int': np.repeat(joint_histograms['Condition_int'], nr_thresholds),
+        'thr_low': np.tile(thresholds_low, nr_images),
+        'thr_high': np.tile(thresholds_high, nr_images),
+        'nr_pixels': nr_pixels.ravel(),
+        'mean_arrival_masked': mean_tau.ravel(),
+        'median_arrival_masked': median_tau.ravel()})
+    
+    # Missing images
+    missing_images = np.repeat(joint_histograms['int_bin_width'] == 0, nr_thresholds)
+    df_masked.loc[missing_images, ['nr_pixels', 'mean_arrival_masked', 'median_arrival_masked']] = np.nan
+    
+    return df_masked
+
+########################################################################
+# Uncertainty of the statistics (bootstrap)
+#
+# To get a sense of the precision of the per-image means and medians, 
+# the pixels of an image can be resampled (with replacement), and the 
+# statistics recalculated for each resample. Rather than resampling 
+# pixels one by one, resampling is done on the histogram of the image: 
+# the number of times each pixel is drawn is taken from a Poisson 
+# distribution with mean 1 (the "Poisson bootstrap", which for large 
+# numbers of pixels is equivalent to the usual bootstrap), such that the 
+# resampled count of a value that occurs c times is Poisson distributed 
+# with mean c. All resamples are drawn at once (an array of resamples x 
+# values), and their means and medians are calculated at once as well.
+#
+# Neighbouring pixels are often correlated (e.g. by the point spread 
+# function), in which case resampling single pixels underestimates the 
+# uncertainty. The block bootstrap therefore resamples square blocks of 
+# UNCERTAINTY_BLOCK_SIZE pixels instead: a histogram is made per block, 
+# and each resample is a weighted sum of those histograms, where the 
+# weights are the number of times each block is drawn.
+#
+# The standard error (column <statistic>_se) is the standard deviation 
+# of the statistic over the resamples, and the confidence interval 
+# (<statistic>_ci_low, <statistic>_ci_high) is given by the percentiles 
+# of the resampled statistics.
+
+UNCERTAINTY_NR_RESAMPLES = 200
+UNCERTAINTY_CI_LEVEL = 0.95
+UNCERTAINTY_BLOCK_SIZE = 64
+UNCERTAINTY_SEED = 0
+
+def bootstrap_histograms(counts, nr_resamples=UNCERTAINTY_NR_RESAMPLES, rng=None):
+    # Resample the pixels described by a histogram (counts) with replacement.
+    # Returns the values that occur in the histogram, and an array 
+    # (resamples, values) with the resampled counts of these values.
+    
+    rng = np.random.default_rng(UNCERTAINTY_SEED) if rng is None else rng
+    values = np.flatnonzero(counts)
+    resampled_counts = rng.poisson(counts[values], size=(nr_resamples, len(values)))
+    
+    return values, resampled_counts
+
+def block_bootstrap_histograms(channel_img, mask=None, nr_resamples=UNCERTAINTY_NR_RESAMPLES, 
+                               block_size=UNCERTAINTY_BLOCK_SIZE, rng=None):
+    # Resample the blocks of block_size x block_size pixels of an 8- or 16-bit 
+    # image with replacement (optionally only using the pixels within mask).
+    # Returns the values that occur in the image, and an array 
+    # (resamples, values) with the resampled counts of these values.
+    
+    if channel_img.dtype not in [np.uint8, np.uint16]:
+        raise ValueError('The block bootstrap requires 8- or 16-bit unsigned images')
+    rng = np.random.default_rng(UNCERTAINTY_SEED) if rng is None else rng
+    
+    # Block number of each pixel
+    nr_block_columns = int(np.ceil(channel_img.shape[1] / block_size))
+    block_ids = (np.arange(channel_img.shape[0]) // block_size)[:, np.newaxis] * nr_block_columns + \
+                (np.arange(channel_img.shape[1]) // block_size)[np.newaxis, :]
+    if mask is None:
+        pixel_values, block_ids = channel_img.ravel(), block_ids.ravel()
+    else:
+        pixel_values, block_ids = channel_img[mask], block_ids[mask]
+    
+    # Histograms per block (only over the values that occur), in one np.bincount call
+    values = np.flatnonzero(np.bincount(pixel_values, minlength=2**(8*channel_img.dtype.itemsize)))
+    value_indices = np.searchsorted(values, pixel_values)
+    nr_blocks = block_ids.max() + 1 if len(block_ids) > 0 else 0
+    block_counts = np.bincount(block_ids.astype(np.int64) * len(values) + value_indices, 
+                               minlength=nr_blocks * len(values)).reshape(nr_blocks, len(values))
+    block_counts = block_counts[block_counts.sum(axis=1) > 0]
+    
+    # Number of times each block is drawn, per resample
+    # (without pixels, e.g. an empty mask, there is nothing to resample; 
+    # uncertainty_from_resampled_histograms then gives NaN)
+    nr_blocks = len(block_counts)
+    if nr_blocks == 0:
+        return values, np.zeros((nr_resamples, 0))
+    block_weights = rng.multinomial(nr_blocks, np.full(nr_blocks, 1 / nr_blocks), size=nr_resamples)
+    resampled_counts = block_weights.astype(float) @ block_counts.astype(float)
+    
+    return values, resampled_counts
+
+def _quantile_from_resampled_histograms(values, resampled_counts, q):
+    # Like _quantile_from_histograms, but for histograms over the given values
+    
+    nr_pixels = resampled_counts.sum(axis=-1)
+    cumulative_counts = np.cumsum(resampled_counts, axis=-1)
+    
+    position = q * (nr_pixels - 1)
+    position_low = np.floor(position)
+    idx_low = np.sum(cumulative_counts <= position_low[:, np.newaxis], axis=-1)
+    idx_high = np.sum(cumulative_counts <= np.ceil(position)[:, np.newaxis], axis=-1)
+    
+    return values[idx_low] + (position - position_low) * (values[idx_high] - values[idx_low])
+
+def uncertainty_from_resampled_histograms(values, resampled_counts, ci_level=UNCERTAINTY_CI_LEVEL):
+    # Standard error and confidence interval of the mean and median, given 
+    # resampled histograms (from bootstrap_histograms or block_bootstrap_histograms).
+    # Returns a dict {'mean': (se, ci_low, ci_high), 'median': (se, ci_low, ci_high)}.
+    
+    if len(values) == 0:
+        return {'mean': (np.nan, np.nan, np.nan), 'median': (np.nan, np.nan, np.nan)}
+    
+    resampled_statistics = {'mean': resampled_counts @ values / resampled_counts.sum(axis=-1),
+                            'median': _quantile_from_resampled_histograms(values, resampled_counts, 0.5)}
+    
+    uncertainty = {}
+    for statistic_name, resampled_values in resampled_statistics.items():
+        ci_low, ci_high = np.quantile(resampled_values, [(1 - ci_level) / 2, (1 + ci_level) / 2])
+        uncertainty[statistic_name] = (np.std(resampled_values, ddof=1), ci_low, ci_high)
+    
+    return uncertainty
+
+########################################################################
+# Uniformity of the images
+#
+# The method assumes that the images show a uniform lysate. To check 
+# this, each image is divided in a grid of regions (e.g. 8x8), and the 
+# median (and mean) intensity and arrival time are determined per region, from the 
+# image that was loaded anyway to calculate the overall statistics. 
+# Gradients, bubbles and edge effects make some regions deviate from the 
+# others. The deviation is expressed as the largest difference between a
+# region and the median over all regions, relative to that median for the
+# intensity (uniformity_deviation_intensity), and in ns for the arrival 
+# time (uniformity_deviation_arrival). The uniformity_score is the largest
+# of these deviations divided by its tolerance, such that a score above 1 
+# indicates a non-uniform image (uniformity_flag). 
+#
+# A median ignores defects that cover less than half of a region (e.g. 
+# a small bubble, or a thin edge effect), whereas the mean does not. The
+# same comparison is therefore also made for the region means, and the
+# deviations are the largest of both.
+#
+# Also in a uniform image, the region medians and means differ by chance,
+# especially for small regions with noisy pixels. The tolerance is 
+# therefore the allowed deviation (UNIFORMITY_MAX_DEVIATION_*) plus 
+# UNIFORMITY_NOISE_Z times the expected standard deviation of a region 
+# median or mean (see region_statistics), such that uniform images are 
+# not flagged.
+
+UNIFORMITY_GRID = 8
+UNIFORMITY_MAX_DEVIATION_INTENSITY = 0.15 # fraction of the median intensity
+UNIFORMITY_MAX_DEVIATION_ARRIVAL = 0.1 # ns
+UNIFORMITY_NOISE_Z = 4 # chance deviations of this many standard deviations are rare, also among 8x8 regions
+UNIFORMITY_MAP_NAMES = ['intensity', 'arrival', 'intensity_mean', 'arrival_mean'] # region medians and means
+
+def _image_regions(channel_img, grid):
+    # Reshape an image to (grid, grid, pixels per region). When the image size 
+    # is not a multiple of grid, the last few rows and columns are not used.
+    
+    region_rows, region_columns = channel_img.shape[0] // grid, channel_img.shape[1] // grid
+    regions = channel_img[:grid*region_rows, :grid*region_columns].reshape(grid, region_rows, grid, region_columns)
+    
+    return regions.transpose(0, 2, 1, 3).reshape(grid, grid, region_rows*region_columns)
+
+def region_statistics(channel_img, grid=UNIFORMITY_GRID):
+    # Median and mean of each region of an image divided in grid x grid regions
+    # (arrays (grid, grid)), and the expected standard deviations of these in a 
+    # uniform image: sd / sqrt(pixels per region) for a mean, and sqrt(pi/2) 
+    # times that for a median, where sd is the standard deviation of the pixels
+    # within a region (the median over all regions, such that differences 
+    # between regions do not count). Returns a dict.
+    
+    regions = _image_regions(channel_img, grid)
+    pixel_sd = np.median(np.std(regions, axis=-1))
+    mean_noise = pixel_sd / np.sqrt(regions.shape[-1])
+    
+    return {'medians': np.median(regions, axis=-1), 'means': np.mean(regions, axis=-1),
+            'median_noise': np.sqrt(np.pi / 2) * mean_noise, 'mean_noise': mean_noise}
+
+def _largest_deviation(region_values, relative=False):
+    overall = np.median(region_values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.max(np.abs(region_values - overall)) / (overall if relative else 1), overall
+
+def uniformity_from_region_statistics(regions_int, regions_tau):
+    # Determine the uniformity columns (see above) from the region statistics
+    # of the intensity and the arrival time (in ns), as from region_statistics:
+    # the region medians and means, and their expected standard deviations. 
+    # Returns a dict.
+    
+    deviations_int, deviations_tau, scores = [], [], []
+    for statistic in ['median', 'mean']:
+        values_int, values_tau = regions_int[statistic + 's'], regions_tau[statistic + 's']
+        values_noise_int, values_noise_tau = regions_int[statistic + '_noise'], regions_tau[statistic + '_noise']
+        deviation_int, overall_int = _largest_deviation(values_int, relative=True)
+        deviation_tau, _ = _largest_deviation(values_tau)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tolerance_int = UNIFORMITY_MAX_DEVIATION_INTENSITY + UNIFORMITY_NOISE_Z * values_noise_int / overall_int
+        tolerance_tau = UNIFORMITY_MAX_DEVIATION_ARRIVAL + UNIFORMITY_NOISE_Z * values_noise_tau
+        deviations_int.append(deviation_int)
+        deviations_tau.append(deviation_tau)
+        scores += [deviation_int / tolerance_int, deviation_tau / tolerance_tau]
+    
+    # (NaN, e.g. for an empty image, is propagated instead of ignored)
+    score = np.max(scores)
+    return {'uniformity_deviation_intensity': float(np.max(deviations_int)), 
+            'uniformity_deviation_arrival': float(np.max(deviations_tau)),
+            'uniformity_score': float(score),
+            'uniformity_flag': bool(score > 1)}
+
+def save_uniformity_maps(uniformity_maps, df_sample_data, path_outputdir):
+    # Save the region medians and means (list with one dict or None per row of 
+    # df_sample_data) in output_<analysis_ID>/analysis_<analysis_ID>__uniformity_maps.npz
+    
+    analysis_ID = df_sample_data['Analysis_ID'].iloc[0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    os.makedirs(path_outputdir_plussubdir, exist_ok=True)
+    
+    # Missing images get maps filled with NaN
+    grid = next((maps['intensity'].shape[0] for maps in uniformity_maps if maps is not None), UNIFORMITY_GRID)
+    empty_maps = {map_name: np.full((grid, grid), np.nan) for map_name in UNIFORMITY_MAP_NAMES}
+    uniformity_maps = [empty_maps if maps is None else maps for maps in uniformity_maps]
+    
+    np.savez_compressed(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__uniformity_maps.npz',
+        **{map_name: np.stack([maps[map_name] for maps in uniformity_maps]) for map_name in UNIFORMITY_MAP_NAMES},
+        File = np.asarray(df_sample_data['File'], dtype=str),
+        Sample = np.asarray(df_sample_data['Sample'], dtype=str),
+        Condition_int = np.asarray(df_sample_data['Condition_int']))
+    
+    return None
+
+def load_uniformity_maps(path_outputdir, analysis_ID):
+    # Load the region medians and means saved by extract_means_and_medians(..., uniformity_grid=..., path_outputdir=...)
+    
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    with np.load(path_outputdir_plussubdir + 'analysis_' + analysis_ID + '__uniformity_maps.npz') as npz_file:
+        uniformity_maps = {key: npz_file[key] for key in npz_file.files}
+    
+    return uniformity_maps
+
+########################################################################
+# Analysis of a single image
+
+# Names of the columns that extract_means_and_medians adds to df_sample_data
+STATS_COLUMNS = ['mean_arrival', 'median_arrival', 'mean_intensity', 'median_intensity']
+
+def _stats_from_file(filepath, reducer='histogram', streaming=False, masking=None, joint_histograms=False, 
+                     profile=False, uncertainty=None, nr_resamples=UNCERTAINTY_NR_RESAMPLES, uniformity_grid=None,
+                     prefetched=None, preview=None):
+    # Load a single image and calculate the mean and median arrival times
+    # and intensities. This function is also what the worker processes run
+    # when extract_means_and_medians is called with n_workers > 1, which is
+    # why it lives at module level.
+    # Returns a dict with the values for the STATS_COLUMNS (and additional 
+    # columns, depending on the options). If joint_histograms is True, the 
+    # joint histogram is stored under the key 'joint_histogram'. If profile 
+    # is True, timings are stored under the key 'profile'. If uniformity_grid
+    # is given, the region medians and means are stored under the key 'uniformity_maps'.
+    # prefetched: optionally, the result of reading the file in advance
+    # (see prefetch_channels), such that the file is not read again.
+    # preview: if given, the statistics are estimated from every preview-th 
+    # pixel of every preview-th row (see preview_mean_and_median).
+    
+    timings = {} if profile else None
+    time_start = time.perf_counter()
+    
+    if streaming:
+        
+        # Accumulate the histograms block by block
+        counts_tau = histogram_from_blocks(iter_channel_blocks(filepath, CHANNEL_TAU))
+        counts_int = histogram_from_blocks(iter_channel_blocks(filepath, CHANNEL_INT))
+        mean_tau, median_tau = mean_from_histogram(counts_tau), median_from_histogram(counts_tau)
+        mean_int, median_int = mean_from_histogram(counts_int), median_from_histogram(counts_int)
+        
+        # The joint histogram is accumulated in a second pass, as the 
+        # intensity bin width depends on the maximum intensity 
+        if joint_histograms:
+            int_bin_width = max(1, int(np.ceil((np.flatnonzero(counts_int)[-1] + 1) / JOINT_HISTOGRAM_INT_BINS)))
+            joint_hist = None
+            for block_int, block_tau in zip(iter_channel_blocks(filepath, CHANNEL_INT), iter_channel_blocks(filepath, CHANNEL_TAU)):
+                block_hist = joint_histogram(block_int, block_tau, int_bin_width=int_bin_width)
+                if joint_hist is None:
+                    joint_hist = block_hist
+                else:
+                    joint_hist['counts'] += block_hist['counts']
+                    joint_hist['tau_sums'] += block_hist['tau_sums']
+    
+    elif preview is not None:
+        
+        # Estimate the statistics from a subsample of the pixels
+        # (reading and decoding are interleaved, so all reading time counts as read_s)
+        img_tau, img_int = read_channels_subsampled(filepath, [CHANNEL_TAU, CHANNEL_INT], preview)
+        if profile:
+            timings.update({'read_s': time.perf_counter() - time_start, 'decode_s': np.nan, 'bytes_read': np.nan})
+        time_start = time.perf_counter()
+        mean_tau, median_tau, mean_tau_error, median_tau_error = preview_mean_and_median(img_tau, 1 / preview**2)
+        mean_int, median_int, mean_int_error, median_int_error = preview_mean_and_median(img_int, 1 / preview**2)
+    
+    else:
+        
+        # Load the two channels of interest
+        if prefetched is None:
+            img_tau, img_int = read_channels(filepath, [CHANNEL_TAU, CHANNEL_INT], timings=timings)
+        elif isinstance(prefetched, Exception):
+            raise prefetched
+        else:
+            (img_tau, img_int), prefetch_timings = prefetched
+            if profile:
+                timings.update(prefetch_timings)
+        time_start = time.perf_counter()
+        
+        # Calculate the mean and median arrival times
+        mean_tau, median_tau = channel_mean_and_median(img_tau, reducer=reducer)
+        
+        # Calculate the mean and median intensity
+        # (This assumes samples were taken under same conditions)        
+        mean_int, median_int = channel_mean_and_median(img_int, reducer=reducer)
+    
+    stats = {'mean_arrival': float(mean_tau / CONVERSION_FACTOR),
+             'median_arrival': float(median_tau / CONVERSION_FACTOR),
+             'mean_intensity': float(mean_int),
+             'median_intensity': float(median_int)}
+    if preview is not None:
+        stats.update({'mean_arrival_error': float(mean_tau_error / CONVERSION_FACTOR),
+                      'median_arrival_error': float(median_tau_error / CONVERSION_FACTOR),
+                      'mean_intensity_error': float(mean_int_error),
+                      'median_intensity_error': float(median_int_error)})
+    
+    # Replace the arrival times by those within the intensity mask
+    mask = None
+    if masking == 'dorus':
+        mask = dorus_intensity_masks(img_int, gamma=DORUS_GAMMA, median_radius=DORUS_MEDIAN_RADIUS, 
+                                     threshold_fraction=DORUS_THRESHOLD_FRACTION)
+        mean_tau, median_tau, mask_fraction = dorus_masked_arrival(img_tau[np.newaxis], img_int[np.newaxis], masks=mask[np.newaxis])
+        stats['mean_arrival'] = float(mean_tau[0])
+        stats['median_arrival'] = float(median_tau[0])
+        stats['mask_fraction'] = float(mask_fraction[0])
+    
+    # Standard errors and confidence intervals, see bootstrap_histograms
+    if uncertainty is not None:
+        rng = np.random.default_rng(UNCERTAINTY_SEED)
+        for channel_name, scale in [('arrival', CONVERSION_FACTOR), ('intensity', 1)]:
+            channel_mask = mask if channel_name == 'arrival' else None
+            if uncertainty == 'block_bootstrap':
+                channel_img = img_tau if channel_name == 'arrival' else img_int
+                values, resampled_counts = block_bootstrap_histograms(channel_img, mask=channel_mask, nr_resamples=nr_resamples, 
+                                                                      block_size=UNCERTAINTY_BLOCK_SIZE, rng=rng)
+            else:
+                if streaming:
+                    counts = counts_tau if channel_name == 'arrival' else counts_int
+                else:
+                    channel_img = img_tau if channel_name == 'arrival' else img_int
+                    counts = histograms_from_stack(channel_img[np.newaxis], None if channel_mask is None else channel_mask[np.newaxis])[0]
+                values, resampled_counts = bootstrap_histograms(counts, nr_resamples=nr_resamples, rng=rng)
+            channel_uncertainty = uncertainty_from_resampled_histograms(values, resampled_counts, ci_level=UNCERTAINTY_CI_LEVEL)
+            for statistic_name, (se, ci_low, ci_high) in channel_uncertainty.items():
+                column = statistic_name + '_' + channel_name
+                stats[column + '_se'] = float(se / scale)
+                stats[column + '_ci_low'] = float(ci_low / scale)
+                stats[column + '_ci_high'] = float(ci_high / scale)
+    
+    if joint_histograms:
+        stats['joint_histogram'] = _sparse_joint_histogram(joint_hist if streaming else joint_histogram(img_int, img_tau))
+    
+    # Uniformity, see region_statistics
+    if uniformity_grid is not None:
+        regions_int = region_statistics(img_int, grid=uniformity_grid)
+        regions_tau = {name: values / CONVERSION_FACTOR for name, values in region_statistics(img_tau, grid=uniformity_grid).items()}
+        stats.update(uniformity_from_region_statistics(regions_int, regions_tau))
+        stats['uniformity_maps'] = {'intensity': regions_int['medians'], 'arrival': regions_tau['medians'],
+                                    'intensity_mean': regions_int['means'], 'arrival_mean': regions_tau['means']}
+    
+    if profile:
+        # when streaming, reading, decoding and reducing are interleaved, so all time counts as reduce_s
+        if streaming:
+            timings.update({'read_s': np.nan, 'decode_s': np.nan, 'bytes_read': os.path.getsize(filepath)})
+        timings['reduce_s'] = time.perf_counter() - time_start
+        stats['profile'] = timings
+    
+    return stats
+
+# The script parameters that determine the outcome of the analysis, with 
+# the analysis option for which they matter (None: always). They are passed
+# on to the worker processes, and recorded in the cache and journal.
+SCRIPT_PARAMETERS = {'CHANNEL_TAU': None, 'CHANNEL_INT': None, 'CONVERSION_FACTOR': None,
+                     'DORUS_GAMMA': 'masking', 'DORUS_MEDIAN_RADIUS': 'masking', 'DORUS_THRESHOLD_FRACTION': 'masking',
+                     'PREVIEW_CONFIDENCE': 'preview',
+                     'UNIFORMITY_MAX_DEVIATION_INTENSITY': 'uniformity_grid', 'UNIFORMITY_MAX_DEVIATION_ARRIVAL': 'uniformity_grid',
+                     'UNIFORMITY_NOISE_Z': 'uniformity_grid',
+                     'UNCERTAINTY_CI_LEVEL': 'uncertainty', 'UNCERTAINTY_SEED': 'uncertainty', 'UNCERTAINTY_BLOCK_SIZE': 'uncertainty'}
+
+def _script_parameters():
+    # The script parameters, as currently set (possibly changed by the user)
+    return {name: globals()[name] for name in SCRIPT_PARAMETERS}
+
+def _initialize_stats_worker(script_parameters):
+    # Worker processes may import this library anew (on Windows and macOS), 
+    # and would then use the default script parameters; so they are passed on
+    globals().update(script_parameters)
+
+def _stats_from_file_or_nan(filepath, **analysis_options):
+    # Wrapper around _stats_from_file that returns the error (as dict 
+    # {'read_error': description}) instead of raising, such that one 
+    # missing or unreadable image does not abort a whole pool of workers.
+    
+    # I use try and except here in case some images are missing.
+    try:
+        return _stats_from_file(filepath, **analysis_options)
+    except Exception as error:
+        return {'read_error': type(error).__name__ + ': ' + str(error)}
+
+########################################################################
+# Cache of per-image statistics
+#
+# Results per image are stored in an SQLite database, such that images
+# that were analyzed before are not read again. An entry is only used if
+# the file still has the same size and modification time, and if it was
+# calculated with the same options and script parameters (see 
+# SCRIPT_PARAMETERS). If the file has changed, its entry is overwritten.
+# When the cache holds more than max_entries images, the entries that 
+# were least recently used are removed.
+
+STATS_CACHE_FILENAME = 'taustats_cache.sqlite'
+STATS_CACHE_MAX_ENTRIES = 100000
+
+def get_stats_cache_path(path_outputdir):
+    # The default location of the cache, next to the output_<analysis_ID> directories
+    return path_outputdir + '/' + STATS_CACHE_FILENAME
+
+def _open_stats_cache(path_cache):
+    
+    connection = sqlite3.connect(path_cache)
+    connection.execute('''CREATE TABLE IF NOT EXISTS image_stats (
+                            filepath TEXT, settings TEXT, 
+                            file_size INTEGER, file_mtime_ns INTEGER, 
+                            stats TEXT, last_used REAL, 
+                            PRIMARY KEY (filepath, settings))''')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON image_stats (last_used)')
+    
+    return connection
+
+def _stats_cache_settings(analysis_options):
+    # The settings that determine the outcome of the analysis, as a string
+    settings = {name: value for name, value in _script_parameters().items()
+                if SCRIPT_PARAMETERS[name] is None or analysis_options.get(SCRIPT_PARAMETERS[name]) is not None}
+    settings.update(analysis_options)
+    # (options that do not affect the values in the cache)
+    settings.pop('joint_histograms', None)
+    settings.pop('profile', None)
+    for option in ['preview', 'uniformity_grid']:
+        if settings.get(option) is None:
+            settings.pop(option, None)
+    if settings.get('uncertainty') is None:
+        settings.pop('uncertainty', None)
+        settings.pop('nr_resamples', None)
+    elif settings['uncertainty'] != 'block_bootstrap':
+        settings.pop('UNCERTAINTY_BLOCK_SIZE')
+    return json.dumps(settings, sort_keys=True)
+
+def _file_identity(filepath):
+    # Returns (absolute path, size, modification time), or None if the file does not exist
+    try:
+        file_stat = os.stat(filepath)
+    except OSError:
+        return None
+    return os.path.abspath(filepath), file_stat.st_size, file_stat.st_mtime_ns
+
+def _get_cached_stats(connection, file_identity, settings):
+    
+    if file_identity is None:
+        return None
+    filepath, file_size, file_mtime_ns = file_identity
+    
+    row = connection.execute('''SELECT stats FROM image_stats 
+                                WHERE filepath=? AND settings=? AND file_size=? AND file_mtime_ns=?''',
+                             (filepath, settings, file_size, file_mtime_ns)).fetchone()
+    if row is None:
+        return None
+    
+    connection.execute('UPDATE image_stats SET last_used=? WHERE filepath=? AND settings=?', 
+                       (time.time(), filepath, settings))
+    
+    return json.loads(row[0])
+
+def _put_cached_stats(connection, file_identity, settings, stats):
+    
+    filepath, file_size, file_mtime_ns = file_identity
+    connection.execute('INSERT OR REPLACE INTO image_stats VALUES (?, ?, ?, ?, ?, ?)',
+                       (filepath, settings, file_size, file_mtime_ns, json.dumps(stats), time.time()))
+
+def prune_stats_cache(path_cache, max_entries=STATS_CACHE_MAX_ENTRIES):
+    # Remove the least recently used entries, such that at most max_entries remain
+    
+    connection = _open_stats_cache(path_cache)
+    with connection:
+        connection.execute('''DELETE FROM image_stats WHERE rowid NOT IN 
+                              (SELECT rowid FROM image_stats ORDER BY last_used DESC LIMIT ?)''', (max_entries,))
+    connection.close()
+    
+    return None
+
+def clear_stats_cache(path_cache, filepaths=None):
+    # Invalidate the cache, either completely, or only for the files in the list filepaths
+    
+    connection = _open_stats_cache(path_cache)
+    with connection:
+        if filepaths is None:
+            connection.execute('DELETE FROM image_stats')
+        else:
+            connection.executemany('DELETE FROM image_stats WHERE filepath=?', 
+                                   [(os.path.abspath(filepath),) for filepath in filepaths])
+    connection.close()
+    
+    return None
+
+########################################################################
+# Journal of a run
+#
+# Results are only added to df_sample_data when all images have been 
+# processed. To not lose the work done when a long run crashes or is 
+# stopped, the results of each image can be written to a journal file as 
+# soon as they are known (one line of json per image, appended to the 
+# file). With resume=True, extract_means_and_medians takes the results of 
+# images that are already in the journal, and only processes the others.
+# Like for the cache, results are only taken from the journal when the 
+# file has not changed, and when the same settings were used.
+
+def get_journal_path(path_outputdir, analysis_ID, name_suffix=''):
+    # Default location of the journal of an analysis (name_suffix can be used 
+    # to give e.g. shards of an analysis their own journal)
+    return path_outputdir + '/output_' + analysis_ID + '/analysis_' + analysis_ID + '__journal' + name_suffix + '.jsonl'
+
+def _read_journal(path_journal, settings):
+    # Returns a dict with, per (absolute) filepath, the last journal entry 
+    # that was made with these settings
+    
+    journal_entries = {}
+    if not os.path.exists(path_journal):
+        return journal_entries
+    
+    with open(path_journal, 'r') as file:
+        for line in file:
+            if line.strip() == '':
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # an incomplete line, written while the run was stopped
+                continue
+            if entry['settings'] == settings:
+                journal_entries[entry['filepath']] = entry
+    
+    return journal_entries
+
+def _write_journal_entry(journal_file, file_identity, settings, stats):
+    
+    filepath, file_size, file_mtime_ns = file_identity
+    journal_file.write(json.dumps({'filepath': filepath, 'file_size': file_size, 'file_mtime_ns': file_mtime_ns, 
+                                   'settings': settings, 'stats': stats}) + '\n')
+    journal_file.flush()
+
+########################################################################
+# Checking which images are present
+#
+# Rather than finding out that a file is missing by trying to open it 
+# (which can take long on a network share), each data directory is listed 
+# once, and the files in the metadata are looked up in those listings. 
+# Files are also found when their extension is .tiff, or when the case of 
+# the name differs (e.g. File_A1.TIF), as long as this identifies a single 
+# file. Rows that refer to the same file are reported as duplicates, and
+# the file is only read once (for the first of these rows).
+
+def _list_directory(directory):
+    # Returns the names of the tif files in directory, or None if it cannot be listed
+    try:
+        with os.scandir(directory) as entries:
+            return [entry.name for entry in entries 
+                    if entry.name.lower().endswith(('.tif', '.tiff')) and entry.is_file()]
+    except OSError:
+        return None
+
+def index_image_files(df_sample_data):
+    # Look up the image file of each row of df_sample_data.
+    # Returns a dataframe with the same index, with columns 
+    #   filename:     subdir/File.tif, as given in the metadata
+    #   filepath:     path of the file (None if not found)
+    #   status:       'found', 'missing', 'ambiguous' (several files match, e.g. 
+    #                 a.tif and A.TIF), or 'no directory' (the directory cannot be listed)
+    #   duplicate_of: for rows that refer to the same file as an earlier row, 
+    #                 the index of that row (otherwise None)
+    
+    directories = (df_sample_data['Datadir'] + '/' + df_sample_data['subdir'].values).tolist()
+    files = df_sample_data['File'].astype(str).tolist()
+    
+    # List each directory once
+    directory_listings = {}
+    for directory in dict.fromkeys(directories):
+        names = _list_directory(directory)
+        if names is None:
+            directory_listings[directory] = None
+            continue
+        names_by_lowercase = {}
+        for name in names:
+            names_by_lowercase.setdefault(name.lower(), []).append(name)
+        directory_listings[directory] = (set(names), names_by_lowercase)
+    
+    filepaths, statuses = [], []
+    for directory, file in zip(directories, files):
+        
+        listing = directory_listings[directory]
+        if listing is None:
+            filepaths.append(None)
+            statuses.append('no directory')
+            continue
+        names, names_by_lowercase = listing
+        
+        # Exact names first, then names that differ in case or extension
+        candidates = [name for name in [file + '.tif', file + '.tiff'] if name in names]
+        if len(candidates) == 0:
+            candidates = names_by_lowercase.get(file.lower() + '.tif', []) + names_by_lowercase.get(file.lower() + '.tiff', [])
+        
+        if len(candidates) == 1:
+            filepaths.append(directory + '/' + candidates[0])
+            statuses.append('found')
+        else:
+            filepaths.append(None)
+            statuses.append('missing' if len(candidates) == 0 else 'ambiguous')
+    
+    df_index = pd.DataFrame({'filename': (df_sample_data['subdir'].astype(str) + '/' + df_sample_data['File'].astype(str) + '.tif').values,
+                             'filepath': pd.Series(filepaths, index=df_sample_data.index, dtype=object), 
+                             'status': statuses}, index=df_sample_data.index)
+    
+    # Rows referring to the same file
+    first_row_per_file = {}
+    duplicate_of = []
+    for idx, filepath in zip(df_index.index, filepaths):
+        if filepath is None:
+            duplicate_of.append(None)
+        else:
+            duplicate_of.append(first_row_per_file.get(filepath))
+            first_row_per_file.setdefault(filepath, idx)
+    df_index['duplicate_of'] = pd.Series(duplicate_of, index=df_index.index, dtype=object)
+    
+    return df_index
+
+def _duplicate_positions(df_index):
+    # Pairs (position of a row, position of the earlier row that refers to the 
+    # same file) for the duplicates found by index_image_files
+    
+    idxs_duplicate = np.flatnonzero(df_index['duplicate_of'].notna().to_numpy())
+    return [(idx, df_index.index.get_loc(df_index['duplicate_of'].iloc[idx])) for idx in idxs_duplicate]
+
+def report_image_index(df_index):
+    # Print the problems found by index_image_files
+    
+    for status, description in [('no directory', 'Directory not found'), ('missing', 'File not found'),
+                                ('ambiguous', 'Several matching files found')]:
+        rows_with_status = df_index.loc[df_index['status'] == status]
+        if len(rows_with_status) > 0:
+            print(description, 'for', len(rows_with_status), 'rows:')
+            for idx, row in rows_with_status.iterrows():
+                print('  ', row['filename'], '(row ' + str(idx) + ')')
+    
+    rows_duplicate = df_index.loc[df_index['duplicate_of'].notna()]
+    for idx, row in rows_duplicate.iterrows():
+        print(row['filename'], '(row ' + str(idx) + ') refers to the same file as', 
+              df_index.loc[row['duplicate_of'], 'filename'], '(row ' + str(row['duplicate_of']) + '):', row['filepath'])
+    
+    return None
+
+def report_read_errors(read_errors, filenames):
+    # Print the files that exist but could not be read (read_errors: list with
+    # a description of the error, or None, per file; filenames: the names to show)
+    
+    idxs_error = [idx for idx, read_error in enumerate(read_errors) if read_error is not None]
+    if len(idxs_error) > 0:
+        print('Could not read', len(idxs_error), 'files (their values are set to NaN):')
+        for idx in idxs_error:
+            print('  ', filenames[idx], '(' + read_errors[idx] + ')')
+    
+    return None
+
+########################################################################
+# Batched analysis of equally sized images
+#
+# In a screen, all wells are usually imaged with the same settings, so 
+# the images have the same size. Rather than reducing each image 
+# separately, the images can then be placed in one stack (images, rows, 
+# columns) and reduced in a single call: the histograms of all images 
+# are made by one np.bincount call (like histograms_from_stack, but only 
+# spanning the range of values that occur in the stack), and the means 
+# and medians of all images follow from those at once. This saves the 
+# overhead of many small calls, which dominates for small images (with 
+# fewer pixels than the 2^16 bins of a per-image histogram). When the 
+# values span a wider range than the number of pixels per image (e.g. 
+# the arrival times of small images), most bins are empty, and the 
+# medians are determined by np.median over the stack instead, which is 
+# faster then and gives the same (exact) values. For larger images, the 
+# time is spent on the pixels rather than on the calls, and 
+# extract_means_and_medians (with n_workers) is equally fast or faster.
+#
+# Images are grouped by shape and data type as they are read. Each group 
+# has a buffer of at most BATCH_SIZE images, which is allocated once and 
+# reused: when it is full, its images are reduced together, and it is 
+# filled again. All buffers together take at most BATCH_MAX_BYTES; if a 
+# new group does not fit, the largest buffers are reduced and freed.
+
+BATCH_SIZE = 32
+BATCH_MAX_BYTES = 2**28 # 256 MB
+BATCH_STACK_MAX_PIXELS = 2**16 # larger images are counted one by one, see stack_means_and_medians
+
+def _medians_from_stacked_histograms(counts):
+    # Exact medians of the histograms in the rows of counts (images, values), 
+    # like median_from_histogram. Rather than searching each histogram, the 
+    # histograms are laid end to end, such that one cumulative sum and one 
+    # np.searchsorted call find the medians of all images.
+    
+    nr_images, nr_values = counts.shape
+    nr_pixels = counts.sum(axis=1)
+    cumulative_counts = np.cumsum(counts.ravel())
+    pixels_before = cumulative_counts[::nr_values] - counts[:, 0] # pixels in the preceding histograms
+    histogram_starts = np.arange(nr_images) * nr_values
+    
+    # (positions are integers, such that cumulative_counts is not converted to floats by np.searchsorted)
+    position = 0.5 * (nr_pixels - 1)
+    position_low, position_high = (nr_pixels - 1) // 2, nr_pixels // 2
+    value_low = np.searchsorted(cumulative_counts, pixels_before + position_low, side='right') - histogram_starts
+    value_high = np.searchsorted(cumulative_counts, pixels_before + position_high, side='right') - histogram_starts
+    medians = value_low + (position - position_low) * (value_high - value_low)
+    
+    return np.where(nr_pixels > 0, medians, np.nan)
+
+def stack_means_and_medians(images, reducer='histogram'):
+    # Mean and median of each image in a 3D stack (images, rows, columns).
+    # Returns two arrays with one value per image. Like channel_mean_and_median,
+    # 8- and 16-bit unsigned images are reduced via histograms (or, when these 
+    # would be mostly empty, np.median, see above; both exact), others by 
+    # np.mean and np.median.
+    
+    if reducer not in ['histogram', 'numpy']:
+        raise ValueError('reducer should be either "histogram" or "numpy"')
+    if images.shape[0] == 0 or images.size == 0:
+        return np.full(images.shape[0], np.nan), np.full(images.shape[0], np.nan)
+    
+    if reducer == 'histogram' and images.dtype in [np.uint8, np.uint16]:
+        
+        # the sums are calculated with integers, so the means are exact
+        means = images.sum(axis=(1,2), dtype=np.int64) / (images.shape[1] * images.shape[2])
+        
+        # histograms from value_min to value_max, each image its own range of bins;
+        # like in histogram_from_channel, np.bincount gets at most HISTOGRAM_CHUNKSIZE 
+        # pixels at once, to keep the temporary 64-bit copy small. Images with more 
+        # than BATCH_STACK_MAX_PIXELS pixels are counted one by one, as for those, 
+        # the overhead of separate calls is small compared to the extra copy.
+        nr_images = images.shape[0]
+        value_min, value_max = int(images.min()), int(images.max())
+        nr_values = value_max - value_min + 1
+        nr_pixels = images.shape[1] * images.shape[2]
+        
+        # mostly empty histograms, see above
+        if nr_values > nr_pixels and nr_pixels <= BATCH_STACK_MAX_PIXELS:
+            return means, np.median(images, axis=(1,2))
+        
+        images_per_chunk = max(1, HISTOGRAM_CHUNKSIZE // nr_pixels)
+        counts = np.empty((nr_images, nr_values), dtype=np.int64)
+        if nr_pixels > BATCH_STACK_MAX_PIXELS:
+            for idx in range(nr_images):
+                counts[idx] = histogram_from_channel(images[idx])[value_min:value_max+1]
+        else:
+            for idx_start in range(0, nr_images, images_per_chunk):
+                images_chunk = images[idx_start:idx_start+images_per_chunk]
+                image_offsets = (np.arange(images_chunk.shape[0], dtype=np.int64) * nr_values - value_min)[:, np.newaxis, np.newaxis]
+                counts[idx_start:idx_start+images_chunk.shape[0]] = np.bincount((images_chunk + image_offsets).ravel(), 
+                    minlength=images_chunk.shape[0]*nr_values).reshape(-1, nr_values)
+        medians = value_min + _medians_from_stacked_histograms(counts)
+        
+        return means, medians
+    
+    return np.mean(images, axis=(1,2)), np.median(images, axis=(1,2))
+
+def extract_means_and_medians_batched(df_sample_data, batch_size=BATCH_SIZE, max_bytes=BATCH_MAX_BYTES,
+                                      reducer='histogram', masking=None, preflight=True, profile=None):
+    # Like extract_means_and_medians, but equally sized images are read into 
+    # a stack and reduced together (see stack_means_and_medians), which is 
+    # faster for screens with many small images. The results are identical.
+    # Only the STATS_COLUMNS (and, with masking, mask_fraction) are determined; 
+    # for the other options (e.g. a cache or multiple processes), use 
+    # extract_means_and_medians.
+    #
+    # batch_size: maximum number of images that are reduced together.
+    # max_bytes:  maximum total size of the buffers (both channels, all groups 
+    #             of images); batches are made smaller if needed. When the buffer for 
+    #             a new group does not fit, the images in the largest buffers are 
+    #             reduced and these buffers are freed (e.g. for tile scans of many sizes).
+    # masking:    None (default) or 'dorus', see extract_means_and_medians. The 
+    #             intensity masks of the images in a batch are determined together 
+    #             (see dorus_intensity_masks).
+    # reducer, preflight and profile: see extract_means_and_medians.
+    
+    if masking not in [None, 'dorus']:
+        raise ValueError('masking should be either None or "dorus"')
+    time_start_extraction = time.perf_counter()
+    
+    # Determine relevant filepaths
+    filepaths = list(df_sample_data['Datadir'] + '/' + df_sample_data['subdir'].values + '/' + df_sample_data['File'].values + '.tif')
+    filenames_brief = df_sample_data['subdir'].values + '/' + df_sample_data['File'].values + '.tif'
+    duplicate_positions = []
+    if preflight:
+        df_index = index_image_files(df_sample_data)
+        report_image_index(df_index)
+        filepaths = df_index['filepath'].tolist()
+        # (duplicates are not read, but get the values of the first row with their file)
+        duplicate_positions = _duplicate_positions(df_index)
+        for idx, _ in duplicate_positions:
+            filepaths[idx] = None
+    
+    columns = STATS_COLUMNS + (['mask_fraction'] if masking == 'dorus' else [])
+    all_stats = np.full((len(filepaths), len(columns)), np.nan)
+    read_errors = [None] * len(filepaths)
+    batches = {} # per (shape, dtype): {'buffer': array (channels, images, rows, columns), 'idxs': rows in the buffer}
+    
+    def reduce_batch(layout):
+        # Reduce the images in the buffer of this layout, and empty it
+        batch = batches[layout]
+        nr_images = len(batch['idxs'])
+        if nr_images == 0:
+            return None
+        time_start = time.perf_counter()
+        images_tau, images_int = batch['buffer'][0, :nr_images], batch['buffer'][1, :nr_images]
+        mean_int, median_int = stack_means_and_medians(images_int, reducer=reducer)
+        if masking == 'dorus':
+            masks = dorus_intensity_masks(images_int, gamma=DORUS_GAMMA, median_radius=DORUS_MEDIAN_RADIUS, 
+                                          threshold_fraction=DORUS_THRESHOLD_FRACTION)
+            mean_tau, median_tau, mask_fraction = dorus_masked_arrival(images_tau, images_int, masks=masks)
+            all_stats[batch['idxs']] = np.column_stack([mean_tau, median_tau, mean_int, median_int, mask_fraction])
+        else:
+            mean_tau, median_tau = stack_means_and_medians(images_tau, reducer=reducer)
+            all_stats[batch['idxs']] = np.column_stack([mean_tau / CONVERSION_FACTOR, median_tau / CONVERSION_FACTOR, 
+                                                        mean_int, median_int])
+        record_profile_entry(profile, 'batch', str(layout[0]), reduce_s=time.perf_counter() - time_start, nr_images=nr_images)
+        batch['idxs'] = []
+        return None
+    
+    def free_buffers(nr_bytes_needed):
+        # Reduce and free the largest buffers until nr_bytes_needed more bytes fit within max_bytes
+        while len(batches) > 0 and sum(batch['buffer'].nbytes for batch in batches.values()) + nr_bytes_needed > max_bytes:
+            layout_largest = max(batches, key=lambda layout: batches[layout]['buffer'].nbytes)
+            reduce_batch(layout_largest)
+            del batches[layout_largest]
+        return None
+    
+    for idx, filepath in enumerate(filepaths):
+        if filepath is None:
+            continue
+        
+        # Read the image
+        time_start = time.perf_counter()
+        try:
+            img_tau, img_int = read_channels(filepath, [CHANNEL_TAU, CHANNEL_INT])
+        except Exception as e:
+            read_errors[idx] = type(e).__name__ + ': ' + str(e)
+            continue
+        if img_tau.shape != img_int.shape or img_tau.dtype != img_int.dtype:
+            read_errors[idx] = 'channels differ in shape or data type'
+            continue
+        
+        # Put it in the buffer of its layout (allocated on first use)
+        layout = (img_tau.shape, img_tau.dtype)
+        if layout not in batches:
+            layout_batch_size = max(1, min(batch_size, max_bytes // (2 * img_tau.nbytes)))
+            free_buffers(2 * layout_batch_size * img_tau.nbytes)
+            batches[layout] = {'buffer': np.empty((2, layout_batch_size) + img_tau.shape, dtype=img_tau.dtype), 'idxs': []}
+        batch = batches[layout]
+        batch['buffer'][0, len(batch['idxs'])] = img_tau
+        batch['buffer'][1, len(batch['idxs'])] = img_int
+        batch['idxs'].append(idx)
+        record_profile_entry(profile, 'file', filenames_brief[idx], read_s=time.perf_counter() - time_start)
+        
+        # Reduce the images in the buffer when it is full
+        if len(batch['idxs']) == batch['buffer'].shape[1]:
+            reduce_batch(layout)
+    
+    # And the images in the buffers that were not full
+    for layout in batches:
+        reduce_batch(layout)
+    
+    report_read_errors(read_errors, filenames_brief)
+    for idx, idx_first in duplicate_positions:
+        all_stats[idx], read_errors[idx] = all_stats[idx_first], read_errors[idx_first]
+    
+    # Now add the values to the dataframe
+    for column_idx, column in enumerate(columns):
+        df_sample_data[column] = all_stats[:, column_idx]
+    df_sample_data['read_error'] = pd.Series(read_errors, index=df_sample_data.index, dtype=object)
+    
+    record_profile_entry(profile, 'stage', 'extract_means_and_medians_batched', 
+                         time_s=time.perf_counter() - time_start_extraction, nr_images=len(filepaths))
+    
+    return df_sample_data
+
 ########################################################################
 # Data analysis
 # Now simply loop over all these samples and calculate the mean value of the image
 
-def extract_means_and_medians(df_sample_data):
+def extract_means_and_medians(df_sample_data, n_workers=1, reducer='histogram', path_cache=None,
+                              cache_max_entries=STATS_CACHE_MAX_ENTRIES, streaming=False, masking=None,
+                              joint_histograms=False, path_outputdir=None, profile=None, 
+                              uncertainty=None, nr_resamples=UNCERTAINTY_NR_RESAMPLES, uniformity_grid=None,
+                              prefetch=0, prefetch_max_bytes=PREFETCH_MAX_BYTES, preflight=True,
+                              path_journal=None, resume=False, preview=None):
+    # Calculate the mean and median arrival times and intensities for all
+    # images listed in df_sample_data.
+    #
+    # n_workers:  number of processes used to read and reduce the images. 
+    #             The default (1) processes the files one by one in the current
+    #             process; None uses all available cores. 
+    #             Results are always stored in the order of the metadata rows.
+    # reducer:    'histogram' (default) or 'numpy', see channel_mean_and_median.
+    # path_cache: optional path to a cache file (e.g. get_stats_cache_path(path_outputdir)),
+    #             images that are in the cache and have not changed are not read again.
+    # cache_max_entries: maximum number of images kept in the cache.
+    # streaming:  if True, images are read in blocks (see iter_channel_blocks), 
+    #             such that images larger than the available memory can be processed.
+    #             This gives exactly the same results as the 'histogram' reducer.
+    # masking:    None (default) uses all pixels. 'dorus' calculates the arrival
+    #             times only over pixels with sufficient intensity, like the ImageJ
+    #             plugin by Dorus (see dorus_intensity_masks). The fraction of pixels
+    #             within the mask is stored in the column mask_fraction.
+    # joint_histograms: if True, a joint histogram of intensity and arrival time is 
+    #             calculated for each image, and saved in the output directory (given by
+    #             path_outputdir), see masked_arrival_from_joint_histograms. 
+    #             As these are not stored in the cache, the cache is then not used to skip images.
+    # profile:    optional run profile (see new_run_profile), in which the time spent
+    #             per file on reading, decoding and reducing is recorded.
+    # uncertainty: None (default), 'bootstrap' or 'block_bootstrap'. If given, the 
+    #             standard error and confidence interval of each statistic are 
+    #             determined from nr_resamples resamples of the pixels (see 
+    #             bootstrap_histograms), and stored in the columns <statistic>_se, 
+    #             <statistic>_ci_low and <statistic>_ci_high.
+    # uniformity_grid: None (default), or the number of regions (e.g. UNIFORMITY_GRID) 
+    #             along each side of the image, to check whether the images are uniform 
+    #             (see region_statistics). This adds the columns uniformity_score and 
+    #             uniformity_flag (and the deviations that the score is based on).
+    #             If path_outputdir is given, the region medians and means are also saved there
+    #             (see load_uniformity_maps), in which case the cache is not used to skip images.
+    # prefetch:   number of files that are read ahead in background threads, while the 
+    #             current file is processed (see prefetch_channels; e.g. PREFETCH_DEPTH). 
+    #             Useful when the images are on a network share. The files that are read 
+    #             ahead take at most prefetch_max_bytes of memory. Only used when n_workers 
+    #             is 1 (multiple worker processes already read and process at the same time).
+    # preflight:  if True (default), the data directories are listed first, to find the
+    #             files (also with extension .tiff, or a different case) and report missing 
+    #             files at once (see index_image_files); only files that exist are read,
+    #             and rows that refer to the same file get the values of its first row. 
+    #             Files that exist but cannot be read are reported separately afterwards,
+    #             and their error is stored in the column read_error (None for other rows).
+    # path_journal: optional path to a journal file (e.g. get_journal_path(path_outputdir, analysis_ID)),
+    #             to which the results of each image are written as soon as they are known.
+    # resume:     if True, images that are already in the journal (with the same settings, 
+    #             and unchanged) are not processed again, such that a run that was stopped 
+    #             can be continued. The outcome is identical to that of an uninterrupted run.
+    #             Otherwise, an existing journal is overwritten. As joint histograms and 
+    #             uniformity maps are not in the journal, images are processed again when these are saved.
+    # preview:    None (default), or a stride (e.g. PREVIEW_STRIDE) for a quick estimate of the 
+    #             statistics from every preview-th pixel of every preview-th row (1/preview^2 of the 
+    #             pixels), reading only the parts of the files that hold these rows where possible.
+    #             The error bound of each estimate is given in the column <statistic>_error
+    #             (see preview_mean_and_median).
+    
+    if streaming and reducer != 'histogram':
+        raise ValueError('streaming is only possible with the "histogram" reducer')
+    if masking not in [None, 'dorus']:
+        raise ValueError('masking should be either None or "dorus"')
+    if streaming and masking is not None:
+        raise ValueError('streaming is not possible in combination with masking')
+    if joint_histograms and path_outputdir is None:
+        raise ValueError('path_outputdir is required to save the joint histograms')
+    if uncertainty not in [None, 'bootstrap', 'block_bootstrap']:
+        raise ValueError('uncertainty should be None, "bootstrap" or "block_bootstrap"')
+    if streaming and uncertainty == 'block_bootstrap':
+        raise ValueError('streaming is not possible in combination with the block bootstrap')
+    if streaming and uniformity_grid is not None:
+        raise ValueError('streaming is not possible in combination with uniformity_grid')
+    if streaming and prefetch > 0:
+        raise ValueError('streaming is not possible in combination with prefetch')
+    if resume and path_journal is None:
+        raise ValueError('path_journal is required to resume a run')
+    if preview is not None and (streaming or masking is not None or joint_histograms or uncertainty is not None or prefetch > 0):
+        raise ValueError('preview is not possible in combination with streaming, masking, joint_histograms, uncertainty or prefetch')
+    analysis_options = {'reducer': reducer, 'streaming': streaming, 'masking': masking, 
+                        'joint_histograms': joint_histograms, 'profile': profile is not None,
+                        'uncertainty': uncertainty, 'nr_resamples': nr_resamples, 'uniformity_grid': uniformity_grid,
+                        'preview': preview}
+    save_uniformity = uniformity_grid is not None and path_outputdir is not None
+    time_start_extraction = time.perf_counter()
     
     # Determine relevant filepaths
     filepaths = df_sample_data['Datadir'] + '/' + df_sample_data['subdir'].values + '/' + df_sample_data['File'].values + '.tif'
     filenames_brief = df_sample_data['subdir'].values + '/' + df_sample_data['File'].values + '.tif'
+    filepaths = list(filepaths)
+    
+    # Look up which files exist (None for files that do not); rows that refer 
+    # to the same file as an earlier row are not read, but get its values afterwards
+    duplicate_positions = []
+    if preflight:
+        df_index = index_image_files(df_sample_data)
+        report_image_index(df_index)
+        filepaths = df_index['filepath'].tolist()
+        duplicate_positions = _duplicate_positions(df_index)
+        for idx, _ in duplicate_positions:
+            filepaths[idx] = None
 
-    # Now calculate the mean values of the images
-    # Initialize arrays to store the calculated values
-    mean_values_tau = np.empty(len(filepaths))
-    median_values_tau = np.empty(len(filepaths))
-    mean_values_int = np.empty(len(filepaths))
-    median_values_int = np.empty(len(filepaths))
-    # Loop over all files
-    for idx, filepath in enumerate(filepaths):
-        
-        # I use try and except here in case some images are missing.
-        try:
-            
-            # Load the image
-            my_img = skio.imread(filepath)
-            
-            # Calculate the mean and median arrival times
-            mean_values_tau[idx] = np.mean(my_img[CHANNEL_TAU,:,:]) / CONVERSION_FACTOR
-            median_values_tau[idx] = np.median(my_img[CHANNEL_TAU,:,:]) / CONVERSION_FACTOR
-            
-            # Calculate the mean and median intensity
-            # (This assumes samples were taken under same conditions)        
-            mean_values_int[idx] = np.mean(my_img[CHANNEL_INT,:,:]) 
-            median_values_int[idx] = np.median(my_img[CHANNEL_INT,:,:]) 
+    # Initialize a list to store the calculated values per image
+    # (None indicates the values are not (yet) known)
+    all_stats = [None] * len(filepaths)
+    all_joint_histograms = [None] * len(filepaths)
+    all_uniformity_maps = [None] * len(filepaths)
+    read_errors = [None] * len(filepaths)
+    
+    # Retrieve the values of images that were analyzed before from the cache
+    cache_settings = _stats_cache_settings(analysis_options)
+    if path_cache is not None or path_journal is not None:
+        file_identities = [None if filepath is None else _file_identity(filepath) for filepath in filepaths]
+    if path_cache is not None:
+        cache_connection = _open_stats_cache(path_cache)
+        for idx in range(len(filepaths)):
+            if not (joint_histograms or save_uniformity):
+                all_stats[idx] = _get_cached_stats(cache_connection, file_identities[idx], cache_settings)
+    nr_images_from_cache = sum(stats is not None for stats in all_stats)
+    
+    # Or from the journal of a previous run
+    if path_journal is not None:
+        if resume and not (joint_histograms or save_uniformity):
+            journal_entries = _read_journal(path_journal, cache_settings)
+            for idx in range(len(filepaths)):
+                if all_stats[idx] is None and file_identities[idx] is not None:
+                    entry = journal_entries.get(file_identities[idx][0])
+                    if entry is not None and (entry['file_size'], entry['file_mtime_ns']) == file_identities[idx][1:]:
+                        all_stats[idx] = entry['stats']
+        os.makedirs(os.path.dirname(os.path.abspath(path_journal)), exist_ok=True)
+        journal_file = open(path_journal, 'a' if resume else 'w')
+        if resume and journal_file.tell() > 0:
+            # start on a new line, in case the last line was not completed
+            journal_file.write('\n')
+    nr_images_from_journal = sum(stats is not None for stats in all_stats) - nr_images_from_cache
+    idxs_todo = [idx for idx in range(len(filepaths)) if all_stats[idx] is None and filepaths[idx] is not None]
+    
+    # Loop over all other files, either here or in a pool of worker processes
+    # (executor.map returns the results in the order of the input)
+    process_file = partial(_stats_from_file_or_nan, **analysis_options)
+    filepaths_todo = [filepaths[idx] for idx in idxs_todo]
+    if n_workers == 1 and prefetch > 0:
+        new_stats = (process_file(filepath, prefetched=prefetched) for filepath, prefetched in 
+                     prefetch_channels(filepaths_todo, [CHANNEL_TAU, CHANNEL_INT], depth=prefetch, max_bytes=prefetch_max_bytes,
+                                       timings=profile is not None))
+    elif n_workers == 1:
+        new_stats = map(process_file, filepaths_todo)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_initialize_stats_worker, 
+                                       initargs=(_script_parameters(),))
+        new_stats = executor.map(process_file, filepaths_todo, chunksize=4)
+    
+    try:
+        for idx, stats in zip(idxs_todo, new_stats):
             
-        except:
+            if 'read_error' in stats:
+                # If the file could not be read, tell user afterwards (data will be set to NaN to indicate missing data)
+                read_errors[idx] = stats['read_error']
+                continue
             
-            # If missing file, tell user and set to NaN to indicate missing data
-            print("Could not read file ", filenames_brief[idx])
-            mean_values_tau[idx] = np.nan
-            median_values_tau[idx] = np.nan
-            mean_values_int[idx] = np.nan
-            median_values_int[idx] = np.nan
-
-    # Now add the mean values to the dataframe
-    df_sample_data['mean_arrival'] = mean_values_tau
-    df_sample_data['median_arrival'] = median_values_tau
-    df_sample_data['mean_intensity'] = mean_values_int
-    df_sample_data['median_intensity'] = median_values_int
+            if joint_histograms:
+                all_joint_histograms[idx] = stats.pop('joint_histogram')
+            if uniformity_grid is not None:
+                all_uniformity_maps[idx] = stats.pop('uniformity_maps')
+            if profile is not None:
+                record_profile_entry(profile, 'file', filenames_brief[idx], **stats.pop('profile'))
+            all_stats[idx] = stats
+            if path_cache is not None and file_identities[idx] is not None:
+                _put_cached_stats(cache_connection, file_identities[idx], cache_settings, stats)
+            if path_journal is not None and file_identities[idx] is not None:
+                _write_journal_entry(journal_file, file_identities[idx], cache_settings, stats)
+    finally:
+        if n_workers != 1:
+            executor.shutdown()
+        if path_journal is not None:
+            journal_file.close()
+        if path_cache is not None:
+            cache_connection.commit()
+            cache_connection.close()
+    
+    if path_cache is not None:
+        prune_stats_cache(path_cache, max_entries=cache_max_entries)
+    report_read_errors(read_errors, filenames_brief)
+    for idx, idx_first in duplicate_positions:
+        all_stats[idx], read_errors[idx] = all_stats[idx_first], read_errors[idx_first]
+        all_joint_histograms[idx], all_uniformity_maps[idx] = all_joint_histograms[idx_first], all_uniformity_maps[idx_first]
+
+    # Now add the values to the dataframe
+    # (the STATS_COLUMNS, plus any additional columns produced by the chosen options)
+    columns = list(STATS_COLUMNS)
+    for stats in all_stats:
+        if stats is not None:
+            columns += [column for column in stats if column not in columns]
+    for column in columns:
+        df_sample_data[column] = np.array([np.nan if stats is None else stats.get(column, np.nan) for stats in all_stats])
+    df_sample_data['read_error'] = pd.Series(read_errors, index=df_sample_data.index, dtype=object)
+    
+    if joint_histograms:
+        save_joint_histograms(all_joint_histograms, df_sample_data, path_outputdir)
+    if save_uniformity:
+        save_uniformity_maps(all_uniformity_maps, df_sample_data, path_outputdir)
+    
+    record_profile_entry(profile, 'stage', 'extract_means_and_medians', 
+                         time_s=time.perf_counter() - time_start_extraction, 
+                         nr_images=len(filepaths), nr_images_from_cache=nr_images_from_cache, 
+                         nr_images_from_journal=nr_images_from_journal)
 
     return df_sample_data
 
@@ -127,41 +1912,176 @@ def calculate_differences(df_sample_data, illustrate_for_beginner=False):
     # Now also calculate the difference between the two conditions
     # This assumes that there's a reference condition and a test condition
     # And that these can be linked by the sample ID stored in "Sample" column
+    # (for more than two conditions, see calculate_contrasts below)
+    # Returns a copy of df_sample_data, with the rows ordered by Sample and Condition_int.
 
     # First order the dataframe such that rows are in the right order
-    df_sample_data.sort_values(by=['Sample', 'Condition_int'], inplace=True) 
+    df_sample_data = df_sample_data.sort_values(by=['Sample', 'Condition_int'])
+
+    # The difference of each row with the previous condition of its sample (NaN for the first
+    # condition), using the pivot table of the contrasts below
+    value_columns = ['median_arrival', 'median_intensity']
+    se_columns = [column + '_se' for column in value_columns if column + '_se' in df_sample_data.columns]
+    values_previous = _values_of_previous_condition(df_sample_data, value_columns + se_columns)
+    df_sample_data['diff_arrival'] = df_sample_data['median_arrival'] - values_previous[:, 0]
+    df_sample_data['diff_intensity'] = df_sample_data['median_intensity'] - values_previous[:, 1]
 
-    # The values can be calculated using the groupby and diff function in one line
-    df_sample_data['diff_arrival'] = df_sample_data.groupby('Sample')['median_arrival'].diff()
-    df_sample_data['diff_intensity'] = df_sample_data.groupby('Sample')['median_intensity'].diff()
+    # If available (see option uncertainty of extract_means_and_medians), also determine the 
+    # uncertainty of the differences. As the two images are independent, their standard errors 
+    # add up in quadrature; the confidence interval assumes the difference is normally distributed.
+    z_value = NormalDist().inv_cdf((1 + UNCERTAINTY_CI_LEVEL) / 2)
+    for diff_column, value_column in [('diff_arrival', 'median_arrival'), ('diff_intensity', 'median_intensity')]:
+        if value_column + '_se' in df_sample_data.columns:
+            se_previous = values_previous[:, len(value_columns) + se_columns.index(value_column + '_se')]
+            df_sample_data[diff_column + '_se'] = np.sqrt(df_sample_data[value_column + '_se']**2 + se_previous**2)
+            df_sample_data[diff_column + '_ci_low'] = df_sample_data[diff_column] - z_value * df_sample_data[diff_column + '_se']
+            df_sample_data[diff_column + '_ci_high'] = df_sample_data[diff_column] + z_value * df_sample_data[diff_column + '_se']
 
     # The code above is perhaps a bit hard to understand, and it can also be done using much more basic commands
     # The code below is not executed per default, but can be used for further customization etc by others if necessary
     if illustrate_for_beginner:
 
-        # First get a list of all the samples
-        list_of_samples = df_sample_data['Sample'].unique()
         df_sample_data['diff_arrival2'] = np.nan
         df_sample_data['diff_intensity2'] = np.nan
         
+        # Go over the samples one by one, each with its own (small) dataframe
         # Assuming Conditions_int holds either 0 or 1 to identify the two conditions
-        for sample in list_of_samples:
+        for sample, df_sample in df_sample_data.groupby('Sample'):
+            
+            row0 = df_sample.loc[df_sample['Condition_int'] == 0]
+            row1 = df_sample.loc[df_sample['Condition_int'] == 1]
+            if len(row0) != 1 or len(row1) != 1:
+                continue # this sample lacks one of the conditions
             
             # difference in arrival times
-            value1 = df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 1), 'median_arrival'].values
-            value0 = df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 0), 'median_arrival'].values
-            value_difference = value1 - value0
-            df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 1), 'diff_arrival2'] = value_difference
+            value_difference = row1['median_arrival'].values - row0['median_arrival'].values
+            df_sample_data.loc[row1.index, 'diff_arrival2'] = value_difference
             
             # difference in intensity
-            value1 = df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 1), 'median_intensity'].values
-            value0 = df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 0), 'median_intensity'].values
-            value_difference = value1 - value0
-            df_sample_data.loc[(df_sample_data['Sample'] == sample) & (df_sample_data['Condition_int'] == 1), 'diff_intensity2'] = value_difference
+            value_difference = row1['median_intensity'].values - row0['median_intensity'].values
+            df_sample_data.loc[row1.index, 'diff_intensity2'] = value_difference
     
     # return the dataframe
     return df_sample_data
 
+########################################################################
+# Contrasts between any number of conditions
+#
+# calculate_differences assumes two conditions per sample. For e.g. dose 
+# series with more conditions, calculate_contrasts and 
+# calculate_pairwise_contrasts calculate differences and ratios between 
+# all conditions (Condition_int) of each sample at once. The values are 
+# first arranged in a table with one row per sample and one column per 
+# condition (a pivot), such that differences between conditions are 
+# simply differences between columns. The input dataframe is not changed.
+# calculate_differences uses the same pivot, to look up the values of the
+# previous condition of each sample.
+
+def _pivot_by_condition(df_sample_data, value_columns):
+    # Returns the samples, the conditions, and an array with the values 
+    # with shape (nr samples, nr conditions, nr value columns), which is 
+    # NaN where a sample lacks a condition. Rows without Sample or 
+    # Condition_int (e.g. blank rows of the metadata file) are left out.
+    
+    df_sample_data = df_sample_data.dropna(subset=['Sample', 'Condition_int'])
+    if df_sample_data.duplicated(['Sample', 'Condition_int']).any():
+        raise ValueError('Each combination of Sample and Condition_int should occur only once.')
+    
+    df_wide = df_sample_data.pivot(index='Sample', columns='Condition_int', values=value_columns)
+    samples = df_wide.index
+    conditions = np.sort(df_sample_data['Condition_int'].unique())
+    df_wide = df_wide.reindex(columns=pd.MultiIndex.from_product([value_columns, conditions]))
+    values = df_wide.to_numpy(dtype=float).reshape(len(samples), len(value_columns), len(conditions)).transpose(0, 2, 1)
+    
+    return samples, conditions, values
+
+def _values_of_previous_condition(df_sample_data, value_columns):
+    # For each row, the values of the row of the same sample with the previous 
+    # condition (the highest Condition_int below that of the row) that is present.
+    # Returns an array (rows, value columns), which is NaN for the first condition 
+    # of each sample, and for rows without Sample or Condition_int.
+    
+    samples, conditions, values = _pivot_by_condition(df_sample_data.assign(_is_present=1.0), value_columns + ['_is_present'])
+    
+    # index of the previous condition that is present (-1 if there is none)
+    is_present = values[:, :, -1] == 1
+    idxs_present = np.where(is_present, np.arange(len(conditions)), -1)
+    idxs_previous = np.concatenate([np.full((len(samples), 1), -1), np.maximum.accumulate(idxs_present, axis=1)[:, :-1]], axis=1)
+    values_previous = np.take_along_axis(values[:, :, :-1], np.maximum(idxs_previous, 0)[:, :, np.newaxis], axis=1)
+    values_previous[idxs_previous < 0] = np.nan
+    
+    # look up each row in the pivot table
+    idx_sample = samples.get_indexer(df_sample_data['Sample'])
+    idx_condition = np.searchsorted(conditions, df_sample_data['Condition_int'])
+    in_pivot = (idx_sample >= 0) & df_sample_data['Condition_int'].notna().to_numpy()
+    values_rows = values_previous[np.where(in_pivot, idx_sample, 0), np.where(in_pivot, idx_condition, 0)]
+    values_rows[~in_pivot] = np.nan
+    
+    return values_rows
+
+def calculate_contrasts(df_sample_data, value_columns=STATS_COLUMNS, reference=0, ratios=True):
+    # Calculate for each row the difference (and ratio) between its values 
+    # and the values of the reference condition (Condition_int == reference) 
+    # of the same sample. Returns a copy of df_sample_data with the columns 
+    # diff_<value column> and ratio_<value column> added. 
+    # Rows of samples without a reference condition, and rows without 
+    # Sample or Condition_int, get NaN.
+    
+    samples, conditions, values = _pivot_by_condition(df_sample_data, value_columns)
+    if reference not in conditions:
+        raise ValueError('Reference condition ' + str(reference) + ' does not occur in Condition_int.')
+    values_reference = values[:, conditions == reference, :]
+    
+    # position of each row in the pivot table (-1 for rows that are not in it)
+    idx_sample = samples.get_indexer(df_sample_data['Sample'])
+    idx_condition = np.searchsorted(conditions, df_sample_data['Condition_int'])
+    in_pivot = (idx_sample >= 0) & df_sample_data['Condition_int'].notna().to_numpy()
+    idx_sample, idx_condition = np.where(in_pivot, idx_sample, 0), np.where(in_pivot, idx_condition, 0)
+    
+    df_output = df_sample_data.copy()
+    differences = (values - values_reference)[idx_sample, idx_condition]
+    differences[~in_pivot] = np.nan
+    for idx_column, value_column in enumerate(value_columns):
+        df_output['diff_' + value_column] = differences[:, idx_column]
+    if ratios:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_values = (values / values_reference)[idx_sample, idx_condition]
+        ratio_values[~in_pivot] = np.nan
+        for idx_column, value_column in enumerate(value_columns):
+            df_output['ratio_' + value_column] = ratio_values[:, idx_column]
+    
+    return df_output
+
+def calculate_pairwise_contrasts(df_sample_data, value_columns=STATS_COLUMNS, ratios=True):
+    # Calculate for each sample the differences (and ratios) between all 
+    # pairs of its conditions. Returns a new dataframe with one row per 
+    # sample and pair of conditions (Condition_int_a < Condition_int_b), 
+    # with columns diff_<value column> (value of b minus value of a) 
+    # and ratio_<value column> (value of b divided by value of a). 
+    # Pairs of which a sample lacks one of the conditions are left out.
+    
+    samples, conditions, values = _pivot_by_condition(df_sample_data, value_columns)
+    idx_a, idx_b = np.triu_indices(len(conditions), k=1)
+    
+    # arrays with shape (nr samples, nr pairs, nr value columns)
+    values_a, values_b = values[:, idx_a, :], values[:, idx_b, :]
+    is_measured = ~np.isnan(values[:, :, 0])
+    pair_exists = (is_measured[:, idx_a] & is_measured[:, idx_b]).ravel()
+    
+    df_contrasts = pd.DataFrame({'Sample': np.repeat(samples, len(idx_a)),
+                                 'Condition_int_a': np.tile(conditions[idx_a], len(samples)),
+                                 'Condition_int_b': np.tile(conditions[idx_b], len(samples))})
+    differences = (values_b - values_a).reshape(-1, len(value_columns))
+    for idx_column, value_column in enumerate(value_columns):
+        df_contrasts['diff_' + value_column] = differences[:, idx_column]
+    if ratios:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_values = (values_b / values_a).reshape(-1, len(value_columns))
+        for idx_column, value_column in enumerate(value_columns):
+            df_contrasts['ratio_' + value_column] = ratio_values[:, idx_column]
+    
+    return df_contrasts.loc[pair_exists].reset_index(drop=True)
+
 def save_dataframe_to_excel(df_sample_data, path_outputdir):
     
     # Get the unique identifier for this analysis
@@ -187,224 +2107,430 @@ def load_dataframe_from_excel(path_outputdir, analysis_ID):
     
     return df_sample_data
 
-########################################################################
-# Plotting
-
-def plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival'):
-
-    # Check input
-    if arrival_or_intensity not in ['arrival', 'intensity']:
-        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
-    if mean_or_median.lower() not in ['mean', 'median']:
-        raise ValueError('mean_or_median should be either "Mean" or "Median"')
-       
-    # Define the output directory
-    analysis_ID = df_sample_data['Analysis_ID'][0]
-    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+# Fast binary storage of the results
+#
+# Excel files are slow to write and read for large screens, and do not 
+# retain the data types of the columns. Therefore, the results are also
+# stored as parquet file (which requires the pyarrow library), which is 
+# what load_dataframe uses when available. The excel file remains 
+# available for inspection by hand.
 
-    # mean_or_median='Median'
-    # mean_or_median='Mean'
-    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
-
-    # now create a little plot like Sebastian showed before
-    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
-    # create a line plot with seaborn, using the mean intensity as the y-axis, and cAMP as x-axis
-    _ = sns.lineplot(df_sample_data, x='Condition_int', y=y_value_toplot, hue='Sample', ax=ax, markers=True, 
-                markersize=10, marker='o', palette=color_palette)
-    # put the legend on the right outside of the plot
-    _ = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-    plt.tight_layout() # required for better display
-    # Axes labels
-    plt.xlabel('Condition')
-    # Add the correct y label
-    if arrival_or_intensity == 'arrival':
-        plt.ylabel(mean_or_median+' arrival time (ns)')
-    else:
-        plt.ylabel(mean_or_median+' intensity (a.u.)')
-    # plt.show()
-    # save it:
-    plt.savefig(path_outputdir_plussubdir + 'lineplot_'+y_value_toplot+'.pdf', dpi=300, bbox_inches='tight')
-    plt.close(fig)
+def _dataframe_for_parquet(df_sample_data):
+    # Parquet columns hold a single type, whereas columns of the (hand-edited) 
+    # metadata file may hold e.g. both text and numbers; such columns are 
+    # stored as text (missing values are kept).
+    
+    df_parquet = df_sample_data.copy()
+    for column in df_parquet.columns[df_parquet.dtypes == object]:
+        values = df_parquet[column].dropna()
+        if len(set(type(value) for value in values)) > 1:
+            df_parquet[column] = df_parquet[column].map(lambda value: value if pd.isna(value) else str(value))
+    
+    return df_parquet
+
+def _save_parquet(df_sample_data, path_parquet, index):
+    # Save a dataframe as parquet file; returns False if this is not possible
+    # (e.g. pyarrow is not installed), in which case no (outdated) parquet file is left
+    
+    try:
+        _dataframe_for_parquet(df_sample_data).to_parquet(path_parquet, index=index)
+        return True
+    except (ImportError, TypeError, ValueError) as e:
+        print('Could not save parquet file (' + type(e).__name__ + ': ' + str(e) + ').')
+        if os.path.exists(path_parquet):
+            os.remove(path_parquet)
+        return False
+
+def save_dataframe(df_sample_data, path_outputdir, excel=True, path_warehouse=None):
+    # Save the dataframe as parquet file, and (if excel is True) also as excel file,
+    # in output_<analysis_ID>/analysis_<analysis_ID>__df_sample_data.parquet/.xlsx
+    # If path_warehouse is given, the results are also added to that warehouse 
+    # (see ingest_into_warehouse).
+    
+    # Get the unique identifier for this analysis
+    analysis_ID = df_sample_data['Analysis_ID'][0]    
+    
+    # define and create a subdirectory if it does not exist
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/'
+    os.makedirs(path_outputdir_plussubdir, exist_ok=True)
+    
+    # Save the dataframe as parquet
+    if not _save_parquet(df_sample_data, path_outputdir_plussubdir + 'analysis_'+analysis_ID+'__df_sample_data.parquet', index=False):
+        print('Saving as excel file instead.')
+        excel = True
+    
+    # And as excel
+    if excel:
+        save_dataframe_to_excel(df_sample_data, path_outputdir)
+    
+    if path_warehouse is not None:
+        ingest_into_warehouse(df_sample_data, path_warehouse, source=path_outputdir_plussubdir)
     
     return None
 
+def load_dataframe(path_outputdir, analysis_ID):
+    # Load the dataframe from the parquet file, or, if that does not exist, from the excel file.
+    
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+    path_parquet = path_outputdir_plussubdir + 'analysis_'+analysis_ID+'__df_sample_data.parquet'
+    
+    if os.path.exists(path_parquet):
+        return pd.read_parquet(path_parquet)
+    
+    return load_dataframe_from_excel(path_outputdir, analysis_ID)
+
+########################################################################
+# Warehouse with the results of all analyses
+#
+# To compare samples across screens, the results of all analyses can be 
+# collected in one SQLite database (the warehouse), which can be queried 
+# by Sample, Condition and Analysis_ID without loading the output of each 
+# analysis separately. For example:
+#
+#   path_warehouse = get_warehouse_path(path_outputdir)
+#   ingest_output_directory(path_outputdir, path_warehouse)
+#   df_results = query_warehouse(path_warehouse, samples=['A1', 'A2'])
+#
+# The warehouse is append-only: ingesting an analysis again (e.g. after 
+# re-analysis) adds a new version of it, and queries return the latest 
+# version of each analysis unless all_versions=True. Ingesting an 
+# analysis whose results did not change since its last ingest does nothing.
+# Sample, Condition, Condition_int and Analysis_ID are stored as separate 
+# (indexed) columns, all other columns of df_sample_data are stored per 
+# row as json, such that analyses with different columns can be combined.
 
-def plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival'):
-    # For debugging or running by selecting:
-    # mean_or_median='Median'; arrival_or_intensity='arrival'
+WAREHOUSE_FILENAME = 'taustats_warehouse.sqlite'
+WAREHOUSE_KEY_COLUMNS = ['Analysis_ID', 'Sample', 'Condition', 'Condition_int']
 
-    # Check input
-    if arrival_or_intensity not in ['arrival', 'intensity']:
-        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
-    if mean_or_median.lower() not in ['mean', 'median']:
-        raise ValueError('mean_or_median should be either "Mean" or "Median"')
+def get_warehouse_path(path_outputdir):
+    # Default location of the warehouse, shared by all analyses in path_outputdir
+    return path_outputdir + '/' + WAREHOUSE_FILENAME
 
-    # Define the output directory
-    analysis_ID = df_sample_data['Analysis_ID'][0]
-    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+def _open_warehouse(path_warehouse):
     
-    # Some information for cosmetics later
-    Condition0_str = df_sample_data[df_sample_data['Condition_int'] == 0]['Condition'].values[0]
-    Condition1_str = df_sample_data[df_sample_data['Condition_int'] == 1]['Condition'].values[0]
-    
-    # mean_or_median='Median'
-    # mean_or_median='Mean'
-    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
-
-    # now create a little plot like Sebastian showed before
-    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
-    # create a line plot with seaborn, using the mean intensity as the y-axis, and cAMP as x-axis
-    _ = sns.lineplot(df_sample_data, x='Condition_int', y=y_value_toplot, hue='Sample', ax=ax, markers=True, 
-                markersize=10, marker='o', palette=color_palette)
-    # remove the usual legend
-    ax.get_legend().remove()
-    # Set x axis to span 0-3
-    ax.set_xlim(-0.5, 2.0)
-    # now add text annotation
-    texts = []
-    df_sample_data_subset = df_sample_data.loc[df_sample_data['Condition_int'] == 1]
-    for idx, row in df_sample_data_subset.iterrows():
-        texts.append( ax.text(row['Condition_int'], row[y_value_toplot], row['Sample'], color='darkgrey', size= plt.rcParams['font.size'] ) )
-    #        
-    #_ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
-    # as in comment above, but force the labels a bit to the right
-    #_ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5))
-    _ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5), min_arrow_len=0)
-                    #target_x=df_sample_data_subset['Condition_int']+.5, target_y=df_sample_data_subset[y_value_toplot],
-                    #x=df_sample_data_subset['Condition_int']+.5, y=df_sample_data_subset[y_value_toplot])
-    plt.tight_layout() # required for better display
-    # Axes labels
-    plt.xlabel('')
-    # Add the correct y label
-    if arrival_or_intensity == 'arrival':
-        plt.ylabel(mean_or_median+' arrival time (ns)')
-    else:
-        plt.ylabel(mean_or_median+' intensity (a.u.)')
-    # Add custom tickmarks that replace "0" and "1" by respective condition names
-    _ = ax.set_xticks([0,1])
-    _ = ax.set_xticklabels([Condition0_str, Condition1_str])
-    # plt.show()
-    # save it:
-    plt.savefig(path_outputdir_plussubdir + 'lineplot_'+y_value_toplot+'_fancy.pdf', dpi=300, bbox_inches='tight')
-    plt.close(fig)
+    connection = sqlite3.connect(path_warehouse)
+    connection.execute('''CREATE TABLE IF NOT EXISTS ingests (
+                            ingest_id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                            Analysis_ID TEXT, source TEXT, content_hash TEXT, 
+                            nr_rows INTEGER, ingested_at TEXT)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                            ingest_id INTEGER, Analysis_ID TEXT, 
+                            Sample TEXT, Condition TEXT, Condition_int INTEGER, 
+                            data TEXT)''')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_ingests_analysis ON ingests (Analysis_ID, ingest_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_results_ingest ON results (ingest_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_results_analysis ON results (Analysis_ID)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_results_sample ON results (Sample)')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_results_condition ON results (Condition, Condition_int)')
     
-    return None
+    return connection
 
-def plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival'):
+def ingest_into_warehouse(df_sample_data, path_warehouse, source=None):
+    # Add the results of one analysis (df_sample_data) to the warehouse.
+    # source: optional description of where the results came from (e.g. a path)
+    # Returns the number of rows added (0 if these results were ingested before).
+    
+    # Analysis_ID is typically only given in the first row
+    analysis_ID = str(df_sample_data['Analysis_ID'].dropna().iloc[0])
+    
+    df_data = df_sample_data.drop(columns=[column for column in WAREHOUSE_KEY_COLUMNS if column in df_sample_data.columns])
+    rows_data = df_data.to_json(orient='records', lines=True).splitlines()
+    content_hash = hashlib.sha256('\n'.join(rows_data).encode() + 
+                                  pd.util.hash_pandas_object(df_sample_data.reindex(columns=WAREHOUSE_KEY_COLUMNS[1:]), index=False).values.tobytes()).hexdigest()
+    
+    samples = df_sample_data['Sample'].astype(str).tolist() if 'Sample' in df_sample_data.columns else [None] * len(df_sample_data)
+    conditions = df_sample_data['Condition'].astype(str).tolist() if 'Condition' in df_sample_data.columns else [None] * len(df_sample_data)
+    conditions_int = [None if pd.isna(value) else int(value) for value in df_sample_data['Condition_int']] \
+                        if 'Condition_int' in df_sample_data.columns else [None] * len(df_sample_data)
+    
+    connection = _open_warehouse(path_warehouse)
+    
+    # Skip if the latest version of this analysis is identical
+    latest = connection.execute('SELECT content_hash FROM ingests WHERE Analysis_ID = ? ORDER BY ingest_id DESC LIMIT 1', 
+                                (analysis_ID,)).fetchone()
+    if latest is not None and latest[0] == content_hash:
+        connection.close()
+        return 0
     
-    # Check input
-    if arrival_or_intensity not in ['arrival', 'intensity']:
-        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
-    if mean_or_median.lower() not in ['mean', 'median']:
-        raise ValueError('mean_or_median should be either "Mean" or "Median"')
+    with connection:
+        cursor = connection.execute('INSERT INTO ingests (Analysis_ID, source, content_hash, nr_rows, ingested_at) VALUES (?, ?, ?, ?, ?)',
+                                    (analysis_ID, source, content_hash, len(df_sample_data), time.strftime('%Y-%m-%d %H:%M:%S')))
+        ingest_id = cursor.lastrowid
+        connection.executemany('INSERT INTO results (ingest_id, Analysis_ID, Sample, Condition, Condition_int, data) VALUES (?, ?, ?, ?, ?, ?)',
+                               zip([ingest_id] * len(rows_data), [analysis_ID] * len(rows_data), samples, conditions, conditions_int, rows_data))
+    connection.close()
+    
+    return len(rows_data)
 
-    # Define the output directory
-    analysis_ID = df_sample_data['Analysis_ID'][0]
-    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+def ingest_output_directory(path_outputdir, path_warehouse=None):
+    # Ingest the results of all analyses in path_outputdir (i.e. all 
+    # output_<analysis_ID> directories with saved results) into the warehouse 
+    # (by default the one given by get_warehouse_path(path_outputdir)).
+    # Returns a dict with, per analysis_ID, the number of rows added.
     
-    # Some information for cosmetics later
-    Condition0_str = df_sample_data[df_sample_data['Condition_int'] == 0]['Condition'].values[0]
-    Condition1_str = df_sample_data[df_sample_data['Condition_int'] == 1]['Condition'].values[0]
+    if path_warehouse is None:
+        path_warehouse = get_warehouse_path(path_outputdir)
     
-    # mean_or_median='Median'
-    # mean_or_median='Mean'
-    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
+    nr_rows_added = {}
+    for entry in sorted(os.scandir(path_outputdir), key=lambda entry: entry.name):
+        
+        if not (entry.is_dir() and entry.name.startswith('output_')):
+            continue
+        analysis_ID = entry.name[len('output_'):]
+        path_results = entry.path + '/analysis_' + analysis_ID + '__df_sample_data'
+        if not (os.path.exists(path_results + '.parquet') or os.path.exists(path_results + '.xlsx')):
+            continue
+        
+        df_sample_data = load_dataframe(path_outputdir, analysis_ID)
+        nr_rows_added[analysis_ID] = ingest_into_warehouse(df_sample_data, path_warehouse, source=entry.path)
     
-    # determine the favorite plot order
-    # order = df_sample_data.sort_values(by=y_value_toplot, ascending=False)['Sample'].values
-    # order the dataframe according to this order
-    y_value_tosortby = 'diff_' + arrival_or_intensity
-    df_sample_data_sorted = df_sample_data.sort_values(by=y_value_tosortby, ascending=False)
+    return nr_rows_added
+
+def query_warehouse(path_warehouse, samples=None, conditions=None, analysis_IDs=None, conditions_int=None, all_versions=False):
+    # Get the results from the warehouse for the given samples, conditions 
+    # (names), conditions_int and/or analysis_IDs (lists; None selects all).
+    # Returns a dataframe with one row per image, with Analysis_ID filled in 
+    # for all rows. With all_versions=True, results from earlier ingests of 
+    # the same analysis are also returned (see columns ingest_id and ingested_at).
     
-    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+    where_clauses, parameters = [], []
+    for column, selection, value_type in [('results.Sample', samples, str), ('results.Condition', conditions, str), 
+                                          ('results.Condition_int', conditions_int, int), ('results.Analysis_ID', analysis_IDs, str)]:
+        if selection is not None:
+            selection = [selection] if np.isscalar(selection) else list(selection)
+            where_clauses.append(column + ' IN (' + ', '.join('?' * len(selection)) + ')')
+            parameters += [value_type(value) for value in selection]
+    if not all_versions:
+        where_clauses.append('results.ingest_id = (SELECT MAX(ingest_id) FROM ingests WHERE ingests.Analysis_ID = results.Analysis_ID)')
     
-    sns.lineplot(df_sample_data_sorted, x='Sample', y=y_value_toplot, hue='Sample', ax=ax, markers=True, linewidth=2, estimator=None)
-        # estimator=None; see "vertical" at https://stackoverflow.com/questions/62667158/how-do-i-increase-the-line-thickness-for-sns-lineplot
-    # now add balls at the end points
-    sns.scatterplot(df_sample_data_sorted[df_sample_data_sorted['Condition_int']==1], x='Sample', y=y_value_toplot, hue='Sample', ax=ax, markers=True, s=100, legend=False)    
+    query = '''SELECT results.ingest_id, ingests.ingested_at, results.Analysis_ID, results.Sample, 
+                      results.Condition, results.Condition_int, results.data 
+               FROM results JOIN ingests ON results.ingest_id = ingests.ingest_id'''
+    if len(where_clauses) > 0:
+        query += ' WHERE ' + ' AND '.join(where_clauses)
+    query += ' ORDER BY results.ingest_id, results.rowid'
     
-    # remove the legend
-    ax.get_legend().remove()
-    # rotate the x-axis labels 90 degrees 
-    plt.xticks(rotation=90)
-    plt.tight_layout()
+    connection = _open_warehouse(path_warehouse)
+    rows = connection.execute(query, parameters).fetchall()
+    connection.close()
     
-    # Axes labels
-    if arrival_or_intensity == 'arrival':
-        plt.ylabel(mean_or_median+' arrival time (ns)')
-    else:
-        plt.ylabel(mean_or_median+' intensity (a.u.)')
-    plt.xlabel('')
-    # plt.show()
+    df_keys = pd.DataFrame([row[:6] for row in rows], columns=['ingest_id', 'ingested_at'] + WAREHOUSE_KEY_COLUMNS)
+    df_data = pd.DataFrame([json.loads(row[6]) for row in rows], index=df_keys.index)
+    df_results = pd.concat([df_keys[WAREHOUSE_KEY_COLUMNS], df_data, df_keys[['ingest_id', 'ingested_at']]], axis=1)
+    if not all_versions:
+        df_results = df_results.drop(columns=['ingest_id', 'ingested_at'])
+    
+    return df_results
+
+########################################################################
+# Splitting an analysis over multiple computers
+#
+# For large screens, the images of one metadata file can be analyzed on 
+# several computers at once (e.g. as jobs of a batch scheduler): each 
+# computer analyzes one shard (a consecutive part of the rows of 
+# df_sample_data), and saves its results with save_shard. Once all 
+# shards are done, merge_shards combines them into one df_sample_data 
+# (in the original row order), after which the differences and plots 
+# can be made as usual. See also run_pipeline_tauimages.py.
+
+def select_shard(df_sample_data, shard_number, nr_shards):
+    # Returns the rows of df_sample_data that belong to shard shard_number 
+    # (1, 2, .., nr_shards). The original index is retained.
+    
+    if not 1 <= shard_number <= nr_shards:
+        raise ValueError('shard_number should be between 1 and nr_shards')
+    
+    idxs_shard = np.array_split(np.arange(len(df_sample_data)), nr_shards)[shard_number - 1]
+    
+    return df_sample_data.iloc[idxs_shard]
+
+def _get_path_shards(path_outputdir, analysis_ID):
+    return path_outputdir + '/output_' + analysis_ID + '/shards/'
+
+def save_shard(df_shard, path_outputdir, analysis_ID, shard_number, nr_shards):
+    # Save the results of one shard in output_<analysis_ID>/shards/ 
+    # (as parquet file, or as excel file if pyarrow is not available)
     
-    # save it:
-    plt.savefig(path_outputdir_plussubdir + 'lineplotvertical_'+y_value_toplot+'.pdf', dpi=300, bbox_inches='tight')
-    plt.close(fig)
+    path_shards = _get_path_shards(path_outputdir, analysis_ID)
+    os.makedirs(path_shards, exist_ok=True)
+    filename = 'analysis_' + analysis_ID + '__shard_' + str(shard_number) + '_of_' + str(nr_shards)
+    
+    # the index is saved as well, such that merge_shards can restore the order of the rows
+    if not _save_parquet(df_shard, path_shards + filename + '.parquet', index=True):
+        df_shard.to_excel(path_shards + filename + '.xlsx', index=True)
     
     return None
 
+def merge_shards(path_outputdir, analysis_ID):
+    # Combine the results of all shards of an analysis (see save_shard) into 
+    # one dataframe. Raises an error when not all shards are available.
+    
+    path_shards = _get_path_shards(path_outputdir, analysis_ID)
+    prefix = 'analysis_' + analysis_ID + '__shard_'
+    
+    shard_files = {}
+    for filename in os.listdir(path_shards):
+        if filename.startswith(prefix) and filename.endswith(('.parquet', '.xlsx')):
+            shard_number, nr_shards = filename[len(prefix):].rsplit('.', 1)[0].split('_of_')
+            shard_files[(int(shard_number), int(nr_shards))] = path_shards + filename
+    
+    nr_shards_found = set(nr_shards for _, nr_shards in shard_files)
+    if len(nr_shards_found) != 1:
+        raise ValueError('Expected the shards of a single split, found splits in ' + str(sorted(nr_shards_found)) + ' shards')
+    nr_shards = nr_shards_found.pop()
+    missing_shards = [shard_number for shard_number in range(1, nr_shards+1) if (shard_number, nr_shards) not in shard_files]
+    if len(missing_shards) > 0:
+        raise ValueError('Shards ' + str(missing_shards) + ' of ' + str(nr_shards) + ' are missing')
+    
+    df_shards = []
+    for shard_number in range(1, nr_shards+1):
+        filepath = shard_files[(shard_number, nr_shards)]
+        if filepath.endswith('.parquet'):
+            df_shards.append(pd.read_parquet(filepath))
+        else:
+            df_shards.append(pd.read_excel(filepath, index_col=0))
+    
+    return pd.concat(df_shards).sort_index()
 
-def scatterplot_diff_intensity_diff_arrival(df_sample_data, path_outputdir):
+########################################################################
+# Processing images while the microscope is acquiring
+#
+# watch_and_process keeps an eye on the data directories listed in the
+# metadata, and processes each image as soon as it has been completely 
+# written. After each round, the differences are re-calculated and the 
+# output files are updated, such that the results for a plate are 
+# available shortly after the last image has been acquired.
+#
+# A file is considered complete when its size and modification time have
+# not changed for stable_polls rounds, and all image data that the tif 
+# header refers to is present in the file.
+
+def _tif_is_complete(filepath):
     
-    # now create a more advance plot, showing a scatter of the two differences, and also color-code the 
-    # points by the mean intensity, and annotate each point with the sample name
+    try:
+        with tifffile.TiffFile(filepath) as tif:
+            file_size = tif.filehandle.size
+            for page in tif.pages:
+                if max(offset + bytecount for offset, bytecount in zip(page.dataoffsets, page.databytecounts)) > file_size:
+                    return False
+    except Exception:
+        return False
     
-    # Define the output directory
-    analysis_ID = df_sample_data['Analysis_ID'][0]
-    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+    return True
+
+def _scan_directories(directories):
+    # Returns a dict with, for each file in the directories, (size, modification time)
     
-    # Select only the relevant data to plot, which is stored with Condition_int==1, this is strictly not necessary as nan values are not plotted
-    df_sample_data_subset = df_sample_data.loc[df_sample_data['Condition_int'] == 1]
-
-    # Now make the plot
-    # Set global font size using rcParams
-    plt.rcParams.update({'font.size': 8})
-    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
-    # seaborn has some weird behavior regarding color bars, so I'll extract the data first and then create a colorbar ..
-    values_diff_intensity = df_sample_data_subset['diff_intensity']
-    values_diff_arrival = df_sample_data_subset['diff_arrival']
-    values_median_intensity = df_sample_data_subset['median_intensity']
-    values_sample_name = df_sample_data_subset['Sample']
-    ax.scatter(values_diff_intensity, values_diff_arrival, c=values_median_intensity, cmap='viridis')
-    # add a colorbar
-    _cbar = plt.colorbar(ax.collections[0], ax=ax)
-    # add a label to the colorbar
-    _cbar.set_label('Mean intensity (a.u.)')
-    # add sample annotation using the value_.. variables
-    texts = []
-    for idx in range(len(values_diff_intensity)):
-        texts.append( ax.text(values_diff_intensity.iloc[idx], values_diff_arrival.iloc[idx], values_sample_name.iloc[idx], color='darkgrey', size= plt.rcParams['font.size'] ) )
-    _ = adjust_text(texts,arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
-    # Add labels etc
-    plt.xlabel('Difference in intensity (a.u.)')
-    plt.ylabel('Difference in arrival time (ns)')
-    plt.tight_layout()
-    # and show the plot
-    # plt.show()
-    # or save it:
-    plt.savefig(path_outputdir_plussubdir + 'scatterplot_diff_intensity_diff_arrival.pdf', dpi=300, bbox_inches='tight')
-    plt.close(fig)
+    file_identities = {}
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        entry_stat = entry.stat()
+                        file_identities[directory + '/' + entry.name] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+        except OSError:
+            # directory does not exist (yet)
+            pass
     
-    return None
+    return file_identities
+
+def _joint_histograms_per_image(joint_histograms):
+    # Split the joint histograms loaded by load_joint_histograms into a list 
+    # with one dict per image (as from _sparse_joint_histogram)
+    
+    offsets = joint_histograms['count_offsets']
+    return [{'count_indices': joint_histograms['count_indices'][offsets[idx]:offsets[idx+1]],
+             'count_values': joint_histograms['count_values'][offsets[idx]:offsets[idx+1]],
+             'tau_sums': joint_histograms['tau_sums'][idx], 
+             'int_bin_width': joint_histograms['int_bin_width'][idx], 
+             'tau_bin_width': joint_histograms['tau_bin_width'][idx]} for idx in range(len(offsets) - 1)]
 
-# The same can be done with seaborn, but seaborn showed some undesirably behavior with regard to the colorbar
-# def scatterplot_diff_intensity_diff_arrival_seaborn(df_sample_data, path_outputdir):
-#     plt.rcParams.update({'font.size': 8}) # actually applies to all plots
-#     fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
-#     _ = sns.scatterplot(df_sample_data_subset, x='diff_intensity', y='diff_arrival', hue='mean_intensity', ax=ax, palette='viridis')
-#     # Now annotate each point with the sample name
-#     # (Code generated using co-pilot)
-#     texts = []
-#     for idx, row in df_sample_data_subset.iterrows():
-#         texts.append( ax.text(row['diff_intensity'], row['diff_arrival'], row['Sample'], color='darkgrey', size= plt.rcParams['font.size'] ) )
-#     _ = adjust_text(texts,arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
-#     # Set the legend location to the outisde
-#     _ = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-#     # Add labels, set font size etc
-#     plt.xlabel('Difference in intensity (a.u.)')
-#     plt.ylabel('Difference in arrival time (ns)')
-#     plt.tight_layout()
-#     # plt.show()
-#     # or save it:
-#     plt.savefig(path_outputdir + 'scatterplot_diff_intensity_diff_arrival_seaborn.pdf', dpi=300, bbox_inches='tight')
-#     plt.close(fig)
+def watch_and_process(df_sample_data, path_outputdir, poll_interval=2, stable_polls=2, timeout=None, **extraction_options):
+    # Process the images in df_sample_data as they appear on disk, until all images 
+    # have been processed, or until no new image was processed for timeout seconds 
+    # (None: wait indefinitely). The dataframe, including the differences, is saved 
+    # (see save_dataframe) after each round in which new images were processed,
+    # as are the joint histograms and uniformity maps of all images processed so
+    # far (when requested), and the results are added to the journal (if given).
+    #
+    # poll_interval:      time (s) between checks of the data directories
+    # stable_polls:       number of checks for which a file should remain unchanged
+    # extraction_options: passed on to extract_means_and_medians (e.g. n_workers), 
+    #                     together with path_outputdir
+    #
+    # Returns the dataframe with all results (like calculate_differences).
+    
+    # Determine the directories to check (the files are looked up in each check, 
+    # like extract_means_and_medians does, see index_image_files)
+    directories = list(dict.fromkeys(df_sample_data['Datadir'] + '/' + df_sample_data['subdir'].values))
+    
+    # Rows that still need to be processed, and how often their file was seen unchanged
+    idxs_todo = list(df_sample_data.index)
+    last_seen_identity = {}
+    nr_unchanged_polls = {}
+    time_last_processed = time.time()
+    df_output = df_sample_data
+    
+    # The joint histograms and uniformity maps that extract_means_and_medians saves
+    # for each round are collected, and saved for all images processed so far
+    analysis_ID = df_sample_data['Analysis_ID'].iloc[0]
+    all_joint_histograms, all_uniformity_maps = {}, {}
+    
+    while len(idxs_todo) > 0:
+        
+        # Check which files are complete
+        file_identities = _scan_directories(directories)
+        filepaths = index_image_files(df_sample_data.loc[idxs_todo])['filepath']
+        idxs_ready = []
+        for idx in idxs_todo:
+            identity = None if filepaths[idx] is None else file_identities.get(filepaths[idx])
+            if identity is not None and identity == last_seen_identity.get(idx):
+                nr_unchanged_polls[idx] += 1
+            else:
+                nr_unchanged_polls[idx] = 0
+            last_seen_identity[idx] = identity
+            if identity is not None and nr_unchanged_polls[idx] >= stable_polls - 1 and _tif_is_complete(filepaths[idx]):
+                idxs_ready.append(idx)
+        
+        # Process these files, and update the output
+        if len(idxs_ready) > 0:
+            
+            # (the Analysis_ID, which is only given in the first row, is needed to save the histograms and maps)
+            df_ready = df_sample_data.loc[idxs_ready].copy()
+            df_ready['Analysis_ID'] = analysis_ID
+            df_ready = extract_means_and_medians(df_ready, path_outputdir=path_outputdir, **extraction_options)
+            df_ready['Analysis_ID'] = df_sample_data.loc[idxs_ready, 'Analysis_ID']
+            if extraction_options.get('path_journal') is not None:
+                # later rounds add to the journal of this run
+                extraction_options['resume'] = True
+            if extraction_options.get('joint_histograms'):
+                all_joint_histograms.update(zip(idxs_ready, _joint_histograms_per_image(load_joint_histograms(path_outputdir, analysis_ID))))
+                save_joint_histograms([all_joint_histograms.get(idx) for idx in df_sample_data.index], df_sample_data, path_outputdir)
+            if extraction_options.get('uniformity_grid') is not None:
+                maps_ready = load_uniformity_maps(path_outputdir, analysis_ID)
+                all_uniformity_maps.update((idx, {map_name: maps_ready[map_name][idx_ready] for map_name in UNIFORMITY_MAP_NAMES}) 
+                                           for idx_ready, idx in enumerate(idxs_ready))
+                save_uniformity_maps([all_uniformity_maps.get(idx) for idx in df_sample_data.index], df_sample_data, path_outputdir)
+            for column in df_ready.columns.difference(df_sample_data.columns):
+                df_sample_data[column] = pd.Series(np.nan, index=df_sample_data.index, 
+                                                   dtype=object if df_ready[column].dtype == object else float)
+            # (columns with True/False, e.g. uniformity_flag, are stored as 1/0, as images that are not yet processed have NaN)
+            df_ready = df_ready.astype({column: float for column in df_ready.columns[df_ready.dtypes == bool]})
+            df_sample_data.loc[idxs_ready, df_ready.columns] = df_ready
+            idxs_todo = [idx for idx in idxs_todo if idx not in idxs_ready]
+            time_last_processed = time.time()
+            
+            df_output = calculate_differences(df_sample_data.copy())
+            save_dataframe(df_output, path_outputdir)
+            print('Processed', len(df_sample_data) - len(idxs_todo), 'of', len(df_sample_data), 'images')
+        
+        # Stop waiting when nothing happened for too long
+        if timeout is not None and time.time() - time_last_processed > timeout:
+            print('No new images for', timeout, 's, stopped waiting for', len(idxs_todo), 'images')
+            break
+        
+        if len(idxs_todo) > 0:
+            time.sleep(poll_interval)
+    
+    return df_output
@@ -0,0 +1,648 @@
+########################################################################
+# About this script
+
+# Plotting functions for the output of lib_pipeline_tauimages_getstats.
+#
+# These functions are kept separate from the analysis functions, such that
+# the (slow to import) plotting libraries are only loaded when plots are 
+# made. They are loaded automatically when used via the analysis library,
+# e.g. taustats.plot_differences_lines(...), but this file can also be 
+# imported directly:
+if False:
+    import sys
+    LIBSCRIPT_DIR = '/Users/m.wehrens/Documents/Python/Python_Libraries/'
+    sys.path.append(LIBSCRIPT_DIR)
+    import lib_pipeline_tauimages_plots as tauplots
+
+########################################################################
+# Library (and thus dependencies)
+
+import seaborn as sns
+import matplotlib.pyplot as plt
+
+# (adjustText is only imported when label_placement='adjust_text' is used)
+
+import numpy as np
+
+import os
+import json
+import time
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from lib_pipeline_tauimages_getstats import record_profile_entry, profile_stage, __version__
+
+cm_to_inch = 1/2.54
+
+color_palette = [
+    "#E69F00",  # Orange
+    "#56B4E9",  # Sky Blue
+    "#009E73",  # Bluish Green
+    "#F0E442",  # Yellow
+    "#0072B2",  # Blue
+    "#D55E00",  # Vermillion
+    "#CC79A7",  # Reddish Purple
+    "#000000"   # Black
+] 
+
+########################################################################
+# Plotting
+
+# Label placement
+#
+# adjust_text (adjustText library) places labels by repeatedly pushing 
+# all labels away from each other, which takes very long (or effectively 
+# hangs) when hundreds of samples are labeled. place_labels is used 
+# instead. Overlapping labels are found with a sweep over the sorted 
+# label positions (rather than comparing all pairs), and only overlapping 
+# labels are pushed apart, for at most max_iterations iterations or 
+# time_budget seconds. Labels are pushed along the direction in which 
+# they overlap least, but sideways when the top or bottom of the plot is 
+# in the way (e.g. for many labels at the same x). When the labels would 
+# cover too much of the plot (more than max_density of its area), when
+# the labels of points with the same x are together higher than the plot,
+# or when labels still overlap after pushing them apart, they are instead 
+# placed in a column to the right of the plot, connected to their points 
+# by lines. The font size is then decreased until the column fits.
+#
+# As the labels are placed in pixels, the layout of the figure (e.g. 
+# tight_layout, axis labels) should be final before place_labels is called.
+
+LABEL_MAX_ITERATIONS = 200
+LABEL_TIME_BUDGET = 2.0 # seconds
+LABEL_MAX_DENSITY = 0.3
+LABEL_OFFSET = 6 # distance (in pixels) between a point and its label
+
+def _overlapping_pairs(left, right, bottom, top):
+    # Find all pairs of boxes that overlap. Returns two arrays (i, j) with the 
+    # indices of the boxes in each pair.
+    # The boxes are sorted along the axis along which they are most spread out; 
+    # for each box, only the boxes that start before it ends along this axis 
+    # are candidates, the other axis is checked afterwards.
+    
+    spread_x = (np.max(right) - np.min(left)) / np.mean(right - left)
+    spread_y = (np.max(top) - np.min(bottom)) / np.mean(top - bottom)
+    if spread_y > spread_x:
+        left, right, bottom, top = bottom, top, left, right
+    
+    order = np.argsort(left)
+    left_sorted, right_sorted = left[order], right[order]
+    nr_boxes = len(left)
+    
+    # candidates of box k (in sorted order) are boxes k+1 .. end_k-1
+    ends = np.searchsorted(left_sorted, right_sorted, side='left')
+    nr_candidates = np.maximum(ends - np.arange(nr_boxes) - 1, 0)
+    idx_first = np.repeat(np.arange(nr_boxes), nr_candidates)
+    idx_second = idx_first + 1 + np.arange(nr_candidates.sum()) - np.repeat(np.cumsum(nr_candidates) - nr_candidates, nr_candidates)
+    i, j = order[idx_first], order[idx_second]
+    
+    overlapping = (bottom[i] < top[j]) & (bottom[j] < top[i])
+    
+    return i[overlapping], j[overlapping]
+
+def _repel_labels(points, widths, heights, axes_bbox, max_iterations, time_budget):
+    # Determine label positions (left, vertical center; in pixels) near the 
+    # points, such that labels do not overlap with each other or with the points.
+    # Returns the positions, and the number of pairs of labels that still overlap.
+    
+    time_end = time.perf_counter() + time_budget
+    nr_labels = len(points)
+    
+    # Start with the labels just right of their points
+    positions = points + np.array([LABEL_OFFSET, 0])
+    # Points are treated as small boxes that do not move
+    point_size = LABEL_OFFSET / 2
+    is_label = np.concatenate([np.ones(nr_labels, dtype=bool), np.zeros(nr_labels, dtype=bool)])
+    
+    for _ in range(max_iterations):
+        
+        left = np.concatenate([positions[:, 0], points[:, 0] - point_size])
+        right = np.concatenate([positions[:, 0] + widths, points[:, 0] + point_size])
+        bottom = np.concatenate([positions[:, 1] - heights/2, points[:, 1] - point_size])
+        top = np.concatenate([positions[:, 1] + heights/2, points[:, 1] + point_size])
+        
+        i, j = _overlapping_pairs(left, right, bottom, top)
+        keep = is_label[i] | is_label[j]
+        i, j = i[keep], j[keep]
+        nr_overlapping_labels = np.sum(is_label[i] & is_label[j])
+        if len(i) == 0 or time.perf_counter() > time_end:
+            break
+        
+        # Push each pair apart along the direction in which they overlap least
+        overlap_x = np.minimum(right[i], right[j]) - np.maximum(left[i], left[j])
+        overlap_y = np.minimum(top[i], top[j]) - np.maximum(bottom[i], bottom[j])
+        direction_x = np.sign((left[i] + right[i]) - (left[j] + right[j]))
+        direction_y = np.sign((bottom[i] + top[i]) - (bottom[j] + top[j]))
+        direction_y[direction_y == 0] = np.where(i < j, -1, 1)[direction_y == 0]
+        direction_x[direction_x == 0] = np.where(i < j, -1, 1)[direction_x == 0]
+        push_along_x = overlap_x < overlap_y
+        
+        # Push sideways when a label would be pushed beyond the top or bottom of the plot
+        at_top = np.concatenate([positions[:, 1] + heights/2 >= axes_bbox.y1 - 1, np.zeros(nr_labels, dtype=bool)])
+        at_bottom = np.concatenate([positions[:, 1] - heights/2 <= axes_bbox.y0 + 1, np.zeros(nr_labels, dtype=bool)])
+        blocked = np.where(direction_y > 0, at_top[i] | at_bottom[j], at_bottom[i] | at_top[j])
+        push_along_x |= blocked
+        
+        push = np.zeros((len(i), 2))
+        push[push_along_x, 0] = (direction_x * (overlap_x + 1))[push_along_x]
+        push[~push_along_x, 1] = (direction_y * (overlap_y + 1))[~push_along_x]
+        
+        # Labels share the push when both move; a label that overlaps a point moves all the way
+        share = np.where(is_label[i] & is_label[j], 0.5, 1.0)[:, np.newaxis]
+        displacement = np.zeros((2 * nr_labels, 2))
+        np.add.at(displacement, i, push * share)
+        np.add.at(displacement, j, -push * share)
+        positions += displacement[:nr_labels]
+        
+        # Keep labels within the plot
+        positions[:, 0] = np.clip(positions[:, 0], axes_bbox.x0, np.maximum(axes_bbox.x1 - widths, axes_bbox.x0))
+        positions[:, 1] = np.clip(positions[:, 1], axes_bbox.y0 + heights/2, axes_bbox.y1 - heights/2)
+    
+    return positions, nr_overlapping_labels
+
+def place_labels(ax, xs, ys, labels, color='darkgrey', fontsize=None, max_iterations=LABEL_MAX_ITERATIONS,
+                 time_budget=LABEL_TIME_BUDGET, max_density=LABEL_MAX_DENSITY):
+    # Add labels to the points (xs, ys) in ax, such that they don't overlap.
+    # Labels that had to be moved away from their point are connected to it by a line.
+    # Returns the list of text objects.
+    
+    if fontsize is None:
+        fontsize = plt.rcParams['font.size']
+    xs, ys, labels = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(labels)
+    has_position = np.isfinite(xs) & np.isfinite(ys)
+    xs, ys, labels = xs[has_position], ys[has_position], labels[has_position]
+    if len(labels) == 0:
+        return []
+    
+    texts = [ax.text(x, y, str(label), color=color, size=fontsize, ha='left', va='center') 
+             for x, y, label in zip(xs, ys, labels)]
+    
+    # Sizes of the labels, and positions of the points, in pixels
+    # (the axis limits are updated first, otherwise transData is outdated)
+    ax.autoscale_view()
+    renderer = ax.figure.canvas.get_renderer()
+    extents = [text.get_window_extent(renderer) for text in texts]
+    widths = np.array([extent.width for extent in extents])
+    heights = np.array([extent.height for extent in extents])
+    points = ax.transData.transform(np.column_stack([xs, ys]))
+    axes_bbox = ax.get_window_extent(renderer)
+    
+    # Whether the labels fit in the plot: by area, and for points with the same x, by height
+    label_density = np.sum(widths * heights) / (axes_bbox.width * axes_bbox.height)
+    _, idxs_same_x = np.unique(np.round(points[:, 0]), return_inverse=True)
+    labels_fit = label_density <= max_density and np.max(np.bincount(idxs_same_x, weights=heights)) <= axes_bbox.height
+    
+    if labels_fit:
+        positions, nr_overlapping_labels = _repel_labels(points, widths, heights, axes_bbox, max_iterations, time_budget)
+        labels_fit = nr_overlapping_labels == 0
+    
+    if labels_fit:
+        
+        positions_data = ax.transData.inverted().transform(positions)
+        for text, point, position, position_data in zip(texts, points, positions, positions_data):
+            text.set_position(position_data)
+            if np.hypot(*(position - point)) > 2 * LABEL_OFFSET:
+                ax.annotate('', xy=ax.transData.inverted().transform(point), xytext=position_data,
+                            arrowprops=dict(arrowstyle='-', color=color, linewidth=.5), annotation_clip=False)
+    
+    else:
+        
+        # Place the labels in a column right of the plot, in the same order as the points,
+        # and decrease the font size if they don't fit (the height of a label is not 
+        # exactly proportional to the font size, so it is measured again)
+        column_fontsize = fontsize
+        for _ in range(10):
+            label_height = np.max(heights)
+            if 1.1 * label_height * len(texts) <= axes_bbox.height:
+                break
+            column_fontsize *= min(0.95, axes_bbox.height / (1.1 * label_height * len(texts)))
+            for text in texts:
+                text.set_fontsize(column_fontsize)
+            heights = np.array([text.get_window_extent(renderer).height for text in texts])
+        spacing = 1.1 * np.max(heights) / axes_bbox.height # in axes coordinates
+        order = np.argsort(points[:, 1])
+        column_ys = 0.5 + (np.arange(len(texts)) - (len(texts) - 1) / 2) * spacing
+        for rank, idx in enumerate(order):
+            texts[idx].set_transform(ax.transAxes)
+            texts[idx].set_position((1.05, column_ys[rank]))
+            texts[idx].set_clip_on(False)
+            ax.annotate('', xy=(xs[idx], ys[idx]), xycoords='data', xytext=(1.04, column_ys[rank]), 
+                        textcoords='axes fraction', arrowprops=dict(arrowstyle='-', color=color, linewidth=.3), 
+                        annotation_clip=False)
+    
+    return texts
+
+########################################################################
+# Skipping plots that are up to date
+#
+# Making a plot can take seconds (in particular when labels are placed), so 
+# plots are only made again when something changed. For each plot, a hash 
+# is calculated of the data in the columns that are used for the plot, the 
+# plot options, and the library version. This hash is stored in the 
+# subdirectory .plot_cache of the output directory, and when it matches, 
+# the existing pdf file is kept. Use force=True to always make the plot.
+
+def _plot_cache_key(df_sample_data, columns, plot_options):
+    
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([__version__, columns, plot_options], sort_keys=True).encode())
+    hasher.update(pd.util.hash_pandas_object(df_sample_data[columns], index=False).values.tobytes())
+    
+    return hasher.hexdigest()
+
+def _path_plot_cache_key(path_plot):
+    return os.path.dirname(path_plot) + '/.plot_cache/' + os.path.basename(path_plot) + '.hash'
+
+def _plot_is_up_to_date(path_plot, cache_key):
+    
+    if not os.path.exists(path_plot) or not os.path.exists(_path_plot_cache_key(path_plot)):
+        return False
+    with open(_path_plot_cache_key(path_plot)) as file:
+        return file.read() == cache_key
+
+def _mark_plot_up_to_date(path_plot, cache_key):
+    
+    os.makedirs(os.path.dirname(_path_plot_cache_key(path_plot)), exist_ok=True)
+    with open(_path_plot_cache_key(path_plot), 'w') as file:
+        file.write(cache_key)
+    
+    return None
+
+########################################################################
+
+def plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival', profile=None, force=False):
+    
+    time_start = time.perf_counter()
+
+    # Check input
+    if arrival_or_intensity not in ['arrival', 'intensity']:
+        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
+    if mean_or_median.lower() not in ['mean', 'median']:
+        raise ValueError('mean_or_median should be either "Mean" or "Median"')
+       
+    # Define the output directory
+    analysis_ID = df_sample_data['Analysis_ID'][0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+
+    # mean_or_median='Median'
+    # mean_or_median='Mean'
+    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
+    
+    # Skip the plot if it is already up to date
+    path_plot = path_outputdir_plussubdir + 'lineplot_'+y_value_toplot+'.pdf'
+    cache_key = _plot_cache_key(df_sample_data, ['Sample', 'Condition_int', y_value_toplot], {'mean_or_median': mean_or_median, 'arrival_or_intensity': arrival_or_intensity})
+    if not force and _plot_is_up_to_date(path_plot, cache_key):
+        record_profile_entry(profile, 'plot', 'lineplot_'+y_value_toplot, time_s=time.perf_counter() - time_start, skipped=True)
+        return None
+
+    # now create a little plot like Sebastian showed before
+    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+    # create a line plot with seaborn, using the mean intensity as the y-axis, and cAMP as x-axis
+    _ = sns.lineplot(df_sample_data, x='Condition_int', y=y_value_toplot, hue='Sample', ax=ax, markers=True, 
+                markersize=10, marker='o', palette=color_palette)
+    # put the legend on the right outside of the plot
+    _ = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    plt.tight_layout() # required for better display
+    # Axes labels
+    plt.xlabel('Condition')
+    # Add the correct y label
+    if arrival_or_intensity == 'arrival':
+        plt.ylabel(mean_or_median+' arrival time (ns)')
+    else:
+        plt.ylabel(mean_or_median+' intensity (a.u.)')
+    # plt.show()
+    # save it:
+    plt.savefig(path_plot, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    _mark_plot_up_to_date(path_plot, cache_key)
+    
+    # Record the time it took to make this plot
+    record_profile_entry(profile, 'plot', 'lineplot_'+y_value_toplot, time_s=time.perf_counter() - time_start)
+    
+    return None
+
+
+def plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival', profile=None, force=False,
+                                       label_placement='fast'):
+    # For debugging or running by selecting:
+    # mean_or_median='Median'; arrival_or_intensity='arrival'
+    # label_placement: 'fast' (see place_labels) or 'adjust_text' (adjustText library)
+    
+    time_start = time.perf_counter()
+
+    # Check input
+    if arrival_or_intensity not in ['arrival', 'intensity']:
+        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
+    if mean_or_median.lower() not in ['mean', 'median']:
+        raise ValueError('mean_or_median should be either "Mean" or "Median"')
+
+    # Define the output directory
+    analysis_ID = df_sample_data['Analysis_ID'][0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+    
+    # Some information for cosmetics later
+    Condition0_str = df_sample_data[df_sample_data['Condition_int'] == 0]['Condition'].values[0]
+    Condition1_str = df_sample_data[df_sample_data['Condition_int'] == 1]['Condition'].values[0]
+    
+    # mean_or_median='Median'
+    # mean_or_median='Mean'
+    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
+    
+    # Skip the plot if it is already up to date
+    path_plot = path_outputdir_plussubdir + 'lineplot_'+y_value_toplot+'_fancy.pdf'
+    cache_key = _plot_cache_key(df_sample_data, ['Sample', 'Condition', 'Condition_int', y_value_toplot], {'mean_or_median': mean_or_median, 'arrival_or_intensity': arrival_or_intensity, 'label_placement': label_placement})
+    if not force and _plot_is_up_to_date(path_plot, cache_key):
+        record_profile_entry(profile, 'plot', 'lineplot_'+y_value_toplot+'_fancy', time_s=time.perf_counter() - time_start, skipped=True)
+        return None
+
+    # now create a little plot like Sebastian showed before
+    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+    # create a line plot with seaborn, using the mean intensity as the y-axis, and cAMP as x-axis
+    _ = sns.lineplot(df_sample_data, x='Condition_int', y=y_value_toplot, hue='Sample', ax=ax, markers=True, 
+                markersize=10, marker='o', palette=color_palette)
+    # remove the usual legend
+    ax.get_legend().remove()
+    # Set x axis to span 0-3
+    ax.set_xlim(-0.5, 2.0)
+    # Axes labels
+    plt.xlabel('')
+    # Add the correct y label
+    if arrival_or_intensity == 'arrival':
+        plt.ylabel(mean_or_median+' arrival time (ns)')
+    else:
+        plt.ylabel(mean_or_median+' intensity (a.u.)')
+    # Add custom tickmarks that replace "0" and "1" by respective condition names
+    _ = ax.set_xticks([0,1])
+    _ = ax.set_xticklabels([Condition0_str, Condition1_str])
+    plt.tight_layout() # required for better display (and before placing the labels, see place_labels)
+    # now add text annotation
+    df_sample_data_subset = df_sample_data.loc[df_sample_data['Condition_int'] == 1]
+    with profile_stage(profile, 'label_placement', 'lineplot_'+y_value_toplot+'_fancy'):
+        if label_placement == 'adjust_text':
+            from adjustText import adjust_text
+            texts = []
+            for idx, row in df_sample_data_subset.iterrows():
+                texts.append( ax.text(row['Condition_int'], row[y_value_toplot], row['Sample'], color='darkgrey', size= plt.rcParams['font.size'] ) )
+            #        
+            #_ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
+            # as in comment above, but force the labels a bit to the right
+            #_ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5))
+            _ = adjust_text(texts, arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5), min_arrow_len=0)
+                            #target_x=df_sample_data_subset['Condition_int']+.5, target_y=df_sample_data_subset[y_value_toplot],
+                            #x=df_sample_data_subset['Condition_int']+.5, y=df_sample_data_subset[y_value_toplot])
+        else:
+            _ = place_labels(ax, df_sample_data_subset['Condition_int'], df_sample_data_subset[y_value_toplot], df_sample_data_subset['Sample'])
+    # plt.show()
+    # save it:
+    plt.savefig(path_plot, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    _mark_plot_up_to_date(path_plot, cache_key)
+    
+    # Record the time it took to make this plot
+    record_profile_entry(profile, 'plot', 'lineplot_'+y_value_toplot+'_fancy', time_s=time.perf_counter() - time_start)
+    
+    return None
+
+def plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival', profile=None, force=False):
+    
+    time_start = time.perf_counter()
+    
+    # Check input
+    if arrival_or_intensity not in ['arrival', 'intensity']:
+        raise ValueError('arrival_or_intensity should be either "arrival" or "intensity"')
+    if mean_or_median.lower() not in ['mean', 'median']:
+        raise ValueError('mean_or_median should be either "Mean" or "Median"')
+
+    # Define the output directory
+    analysis_ID = df_sample_data['Analysis_ID'][0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+    
+    # Some information for cosmetics later
+    Condition0_str = df_sample_data[df_sample_data['Condition_int'] == 0]['Condition'].values[0]
+    Condition1_str = df_sample_data[df_sample_data['Condition_int'] == 1]['Condition'].values[0]
+    
+    # mean_or_median='Median'
+    # mean_or_median='Mean'
+    y_value_toplot = mean_or_median.lower() + '_' + arrival_or_intensity
+    
+    # Skip the plot if it is already up to date
+    path_plot = path_outputdir_plussubdir + 'lineplotvertical_'+y_value_toplot+'.pdf'
+    cache_key = _plot_cache_key(df_sample_data, ['Sample', 'Condition_int', y_value_toplot, 'diff_' + arrival_or_intensity], {'mean_or_median': mean_or_median, 'arrival_or_intensity': arrival_or_intensity})
+    if not force and _plot_is_up_to_date(path_plot, cache_key):
+        record_profile_entry(profile, 'plot', 'lineplotvertical_'+y_value_toplot, time_s=time.perf_counter() - time_start, skipped=True)
+        return None
+    
+    # determine the favorite plot order
+    # order = df_sample_data.sort_values(by=y_value_toplot, ascending=False)['Sample'].values
+    # order the dataframe according to this order
+    y_value_tosortby = 'diff_' + arrival_or_intensity
+    df_sample_data_sorted = df_sample_data.sort_values(by=y_value_tosortby, ascending=False)
+    
+    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+    
+    sns.lineplot(df_sample_data_sorted, x='Sample', y=y_value_toplot, hue='Sample', ax=ax, markers=True, linewidth=2, estimator=None)
+        # estimator=None; see "vertical" at https://stackoverflow.com/questions/62667158/how-do-i-increase-the-line-thickness-for-sns-lineplot
+    # now add balls at the end points
+    sns.scatterplot(df_sample_data_sorted[df_sample_data_sorted['Condition_int']==1], x='Sample', y=y_value_toplot, hue='Sample', ax=ax, markers=True, s=100, legend=False)    
+    
+    # remove the legend
+    ax.get_legend().remove()
+    # rotate the x-axis labels 90 degrees 
+    plt.xticks(rotation=90)
+    plt.tight_layout()
+    
+    # Axes labels
+    if arrival_or_intensity == 'arrival':
+        plt.ylabel(mean_or_median+' arrival time (ns)')
+    else:
+        plt.ylabel(mean_or_median+' intensity (a.u.)')
+    plt.xlabel('')
+    # plt.show()
+    
+    # save it:
+    plt.savefig(path_plot, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    _mark_plot_up_to_date(path_plot, cache_key)
+    
+    # Record the time it took to make this plot
+    record_profile_entry(profile, 'plot', 'lineplotvertical_'+y_value_toplot, time_s=time.perf_counter() - time_start)
+    
+    return None
+
+
+def scatterplot_diff_intensity_diff_arrival(df_sample_data, path_outputdir, profile=None, force=False, label_placement='fast'):
+    
+    time_start = time.perf_counter()
+    
+    # now create a more advance plot, showing a scatter of the two differences, and also color-code the 
+    # points by the mean intensity, and annotate each point with the sample name
+    # label_placement: 'fast' (see place_labels) or 'adjust_text' (adjustText library)
+    
+    # Define the output directory
+    analysis_ID = df_sample_data['Analysis_ID'][0]
+    path_outputdir_plussubdir = path_outputdir + '/output_' + analysis_ID + '/' 
+    
+    # Skip the plot if it is already up to date
+    path_plot = path_outputdir_plussubdir + 'scatterplot_diff_intensity_diff_arrival.pdf'
+    cache_key = _plot_cache_key(df_sample_data, ['Sample', 'Condition_int', 'diff_intensity', 'diff_arrival', 'median_intensity'], {'label_placement': label_placement})
+    if not force and _plot_is_up_to_date(path_plot, cache_key):
+        record_profile_entry(profile, 'plot', 'scatterplot_diff_intensity_diff_arrival', time_s=time.perf_counter() - time_start, skipped=True)
+        return None
+    
+    # Select only the relevant data to plot, which is stored with Condition_int==1, this is strictly not necessary as nan values are not plotted
+    df_sample_data_subset = df_sample_data.loc[df_sample_data['Condition_int'] == 1]
+
+    # Now make the plot
+    # Set global font size using rcParams
+    plt.rcParams.update({'font.size': 8})
+    fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+    # seaborn has some weird behavior regarding color bars, so I'll extract the data first and then create a colorbar ..
+    values_diff_intensity = df_sample_data_subset['diff_intensity']
+    values_diff_arrival = df_sample_data_subset['diff_arrival']
+    values_median_intensity = df_sample_data_subset['median_intensity']
+    values_sample_name = df_sample_data_subset['Sample']
+    ax.scatter(values_diff_intensity, values_diff_arrival, c=values_median_intensity, cmap='viridis')
+    # add a colorbar
+    _cbar = plt.colorbar(ax.collections[0], ax=ax)
+    # add a label to the colorbar
+    _cbar.set_label('Mean intensity (a.u.)')
+    # Add labels etc (before placing the sample labels, see place_labels)
+    plt.xlabel('Difference in intensity (a.u.)')
+    plt.ylabel('Difference in arrival time (ns)')
+    plt.tight_layout()
+    # add sample annotation using the value_.. variables
+    with profile_stage(profile, 'label_placement', 'scatterplot_diff_intensity_diff_arrival'):
+        if label_placement == 'adjust_text':
+            from adjustText import adjust_text
+            texts = []
+            for idx in range(len(values_diff_intensity)):
+                texts.append( ax.text(values_diff_intensity.iloc[idx], values_diff_arrival.iloc[idx], values_sample_name.iloc[idx], color='darkgrey', size= plt.rcParams['font.size'] ) )
+            _ = adjust_text(texts,arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
+        else:
+            _ = place_labels(ax, values_diff_intensity, values_diff_arrival, values_sample_name)
+    # and show the plot
+    # plt.show()
+    # or save it:
+    plt.savefig(path_plot, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    _mark_plot_up_to_date(path_plot, cache_key)
+    
+    # Record the time it took to make this plot
+    record_profile_entry(profile, 'plot', 'scatterplot_diff_intensity_diff_arrival', time_s=time.perf_counter() - time_start)
+    
+    return None
+
+# The same can be done with seaborn, but seaborn showed some undesirably behavior with regard to the colorbar
+# def scatterplot_diff_intensity_diff_arrival_seaborn(df_sample_data, path_outputdir):
+#     plt.rcParams.update({'font.size': 8}) # actually applies to all plots
+#     fig, ax = plt.subplots(1,1,figsize=(10*cm_to_inch,10*cm_to_inch))
+#     _ = sns.scatterplot(df_sample_data_subset, x='diff_intensity', y='diff_arrival', hue='mean_intensity', ax=ax, palette='viridis')
+#     # Now annotate each point with the sample name
+#     # (Code generated using co-pilot)
+#     texts = []
+#     for idx, row in df_sample_data_subset.iterrows():
+#         texts.append( ax.text(row['diff_intensity'], row['diff_arrival'], row['Sample'], color='darkgrey', size= plt.rcParams['font.size'] ) )
+#     _ = adjust_text(texts,arrowprops=dict(arrowstyle='->', color='darkgrey', linewidth=.5) )
+#     # Set the legend location to the outisde
+#     _ = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+#     # Add labels, set font size etc
+#     plt.xlabel('Difference in intensity (a.u.)')
+#     plt.ylabel('Difference in arrival time (ns)')
+#     plt.tight_layout()
+#     # plt.show()
+#     # or save it:
+#     plt.savefig(path_outputdir + 'scatterplot_diff_intensity_diff_arrival_seaborn.pdf', dpi=300, bbox_inches='tight')
+#     plt.close(fig)
+
+########################################################################
+# Making all plots at once
+#
+# render_all_plots makes the complete set of plots (the same plots as 
+# in projects/example_project.py), in parallel in separate processes. 
+# These use the non-interactive 'Agg' backend, as the plots are only 
+# saved. If one plot fails, the other plots are still made, and the 
+# error is reported at the end.
+
+ALL_PLOTS = [
+    ('plot_differences_lines', {'mean_or_median': 'Median', 'arrival_or_intensity': 'intensity'}),
+    ('plot_differences_lines', {'mean_or_median': 'Mean', 'arrival_or_intensity': 'intensity'}),
+    ('plot_differences_lines', {'mean_or_median': 'Median', 'arrival_or_intensity': 'arrival'}),
+    ('plot_differences_lines', {'mean_or_median': 'Mean', 'arrival_or_intensity': 'arrival'}),
+    ('plot_differences_lines_fancylabels', {'mean_or_median': 'Median', 'arrival_or_intensity': 'intensity'}),
+    ('plot_differences_lines_fancylabels', {'mean_or_median': 'Mean', 'arrival_or_intensity': 'intensity'}),
+    ('plot_differences_lines_fancylabels', {'mean_or_median': 'Median', 'arrival_or_intensity': 'arrival'}),
+    ('plot_differences_lines_fancylabels', {'mean_or_median': 'Mean', 'arrival_or_intensity': 'arrival'}),
+    ('plot_differences_bars', {'mean_or_median': 'Median', 'arrival_or_intensity': 'arrival'}),
+    ('plot_differences_bars', {'mean_or_median': 'Median', 'arrival_or_intensity': 'intensity'}),
+    ('scatterplot_diff_intensity_diff_arrival', {})]
+
+def _initialize_plot_worker():
+    # Worker processes only save plots, so they don't need an interactive backend
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _render_plot(plot_name, plot_options, df_sample_data, path_outputdir, force=False):
+    # Make a single plot; returns (time it took, error message or None)
+    
+    time_start = time.perf_counter()
+    try:
+        globals()[plot_name](df_sample_data, path_outputdir, force=force, **plot_options)
+        error_message = None
+    except Exception:
+        error_message = traceback.format_exc()
+    
+    return time.perf_counter() - time_start, error_message
+
+def render_all_plots(df_sample_data, path_outputdir, n_workers=None, plots=ALL_PLOTS, profile=None, force=False):
+    # Make all plots in the list plots (default: ALL_PLOTS), which holds 
+    # (name of plot function, dict with its parameters) pairs.
+    #
+    # n_workers: number of processes used to make the plots (None: all cores). 
+    #            With n_workers=1, the plots are made one by one in this process.
+    # profile:   optional run profile, in which the time per plot is recorded.
+    # force:     if True, also make plots that are up to date.
+    #
+    # Returns a dict with, for each plot that failed, the error message.
+    
+    plot_descriptions = [plot_name + '(' + ', '.join(key + '=' + repr(value) for key, value in plot_options.items()) + ')'
+                         for plot_name, plot_options in plots]
+    
+    # Make the plots here, or in a pool of worker processes
+    if n_workers == 1:
+        # the plots are only saved, so also here no interactive backend is needed 
+        # (the previous backend is restored afterwards)
+        import matplotlib
+        previous_backend = matplotlib.get_backend()
+        matplotlib.use('Agg')
+        try:
+            all_results = [_render_plot(plot_name, plot_options, df_sample_data, path_outputdir, force) 
+                           for plot_name, plot_options in plots]
+        finally:
+            matplotlib.use(previous_backend)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_initialize_plot_worker) as executor:
+            futures = [executor.submit(_render_plot, plot_name, plot_options, df_sample_data, path_outputdir, force)
+                       for plot_name, plot_options in plots]
+            all_results = []
+            for future in futures:
+                try:
+                    all_results.append(future.result())
+                except Exception:
+                    # e.g. the worker process crashed
+                    all_results.append((np.nan, traceback.format_exc()))
+    
+    # Report
+    errors = {}
+    for plot_description, (duration, error_message) in zip(plot_descriptions, all_results):
+        record_profile_entry(profile, 'plot', plot_description, time_s=duration, failed=error_message is not None)
+        if error_message is not None:
+            errors[plot_description] = error_message
+    
+    print('Made', len(plots) - len(errors), 'of', len(plots), 'plots')
+    for plot_description, error_message in errors.items():
+        print('Failed to make', plot_description + ':\n' + error_message)
+    
+    return errors
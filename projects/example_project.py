@@ -53,32 +53,76 @@ df_sample_metadata, df_sample_data = taustats.initialize_analysis(path_sample_me
 
 # Now loop over the samples and analyze them
 df_sample_data = taustats.extract_means_and_medians(df_sample_data)
+# For large screens, the images can be processed by multiple processes in parallel, e.g.:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, n_workers=8)
+# For screens with many small images of the same size, reducing them in batches is faster:
+# df_sample_data = taustats.extract_means_and_medians_batched(df_sample_data)
+# When the data is on a network share, reading the next files while analyzing the current one helps:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, prefetch=4)
+# To only use pixels with sufficient intensity, as done by the ImageJ plugin from Dorus, use:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, masking='dorus')
+# or, for many images of the same size, in batches:
+# df_sample_data = taustats.extract_means_and_medians_batched(df_sample_data, masking='dorus')
+# To explore intensity thresholds later without reading the images again, store joint histograms:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, joint_histograms=True, path_outputdir=path_outputdir)
+# joint_histograms = taustats.load_joint_histograms(path_outputdir, analysis_ID)
+# df_masked = taustats.masked_arrival_from_joint_histograms(joint_histograms, thresholds_low=50, thresholds_high=250)
+# To also determine standard errors and confidence intervals of the values (and their differences), use:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, uncertainty='block_bootstrap')
+# To check whether the images are uniform (see columns uniformity_score and uniformity_flag), use:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, uniformity_grid=8)
+# For a quick first look (e.g. during acquisition), estimate the values from 1/16th of the pixels,
+# with error bounds in the columns <column>_error:
+# df_preview = taustats.extract_means_and_medians(df_sample_data.copy(), preview=taustats.PREVIEW_STRIDE)
+# Images that were analyzed before can be skipped by using a cache file, e.g.:
+# df_sample_data = taustats.extract_means_and_medians(df_sample_data, path_cache=taustats.get_stats_cache_path(path_outputdir))
 df_sample_data = taustats.calculate_differences(df_sample_data)
+# With more than two conditions per sample (e.g. a dose series), differences and ratios relative to 
+# condition 0, or between all pairs of conditions, can be calculated using:
+# df_sample_data = taustats.calculate_contrasts(df_sample_data, reference=0)
+# df_contrasts = taustats.calculate_pairwise_contrasts(df_sample_data)
 
-# Save the dataframe as excel file
-taustats.save_dataframe_to_excel(df_sample_data, path_outputdir)
+# Save the dataframe (as parquet and excel file)
+taustats.save_dataframe(df_sample_data, path_outputdir)
+# To also add the results to the database with results of all analyses (see query_warehouse), use:
+# taustats.save_dataframe(df_sample_data, path_outputdir, path_warehouse=taustats.get_warehouse_path(path_outputdir))
 
+# Alternatively, while the microscope is still acquiring, the steps above can be replaced by 
+# the following, which processes images as soon as they have been written, and updates the output files:
+# df_sample_data = taustats.watch_and_process(df_sample_data, path_outputdir, timeout=600)
 
-# If you later just want to plot some data, you can load the dataframe from the excel file
+
+# If you later just want to plot some data, you can load the saved dataframe (this uses the parquet file,
+# or the excel file if there is no parquet file).
 # This requires you to provide analysis_ID, here '20241030_martijn' is given as example.
-# analysis_ID = '20241030_martijn'; df_sample_data = taustats.load_dataframe_from_excel(path_outputdir, analysis_ID)
+# analysis_ID = '20241030_martijn'; df_sample_data = taustats.load_dataframe(path_outputdir, analysis_ID)
+# To compare samples across all analyses in path_outputdir, collect them in the warehouse and query it, e.g.:
+# taustats.ingest_output_directory(path_outputdir)
+# df_A1 = taustats.query_warehouse(taustats.get_warehouse_path(path_outputdir), samples=['A1'])
 
 
 # Now plot data
-taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
-taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='intensity')
-taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
-taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='arrival')
-
-taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
-taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='intensity')
-taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
-taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='arrival')
-
-taustats.plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
-taustats.plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
-
-taustats.scatterplot_diff_intensity_diff_arrival(df_sample_data, path_outputdir)
+# This makes all plots (see ALL_PLOTS in lib_pipeline_tauimages_plots.py for the list of plots)
+taustats.render_all_plots(df_sample_data, path_outputdir, n_workers=1)
+# They can also be made in parallel, using n_workers=None (all cores); when running this script 
+# as a whole rather than line by line, the code should then be placed under an 
+# "if __name__ == '__main__':" block (on Windows and macOS).
+
+# The plots can also be made one by one:
+# taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
+# taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='intensity')
+# taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
+# taustats.plot_differences_lines(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='arrival')
+
+# taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
+# taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='intensity')
+# taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
+# taustats.plot_differences_lines_fancylabels(df_sample_data, path_outputdir, mean_or_median='Mean', arrival_or_intensity='arrival')
+
+# taustats.plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='arrival')
+# taustats.plot_differences_bars(df_sample_data, path_outputdir, mean_or_median='Median', arrival_or_intensity='intensity')
+
+# taustats.scatterplot_diff_intensity_diff_arrival(df_sample_data, path_outputdir)
 
 # To further customize the plots, you can also simply look at the code in the library and copy it here,
 # and then change the code to your liking.
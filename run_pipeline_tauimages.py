@@ -0,0 +1,201 @@
+########################################################################
+# About this script
+
+# Command line interface to the pipeline, such that an analysis can be
+# run without editing a project script (e.g. on a server, or by a batch
+# scheduler). For example:
+#
+#   python run_pipeline_tauimages.py run SampleList.xlsx --outputdir analysis_output --jobs 8
+#
+# runs all stages: extracting the statistics from the images (extract),
+# calculating the differences (differences), saving the dataframe (save)
+# and making the plots (plots). With --stages, only some of these are run;
+# e.g. "--stages plots" re-makes the plots from saved results. When the
+# extract stage is run without the save stage, the extracted statistics
+# are still saved (as parquet file), such that later stages can use them.
+#
+# To divide the images over several computers, give each computer one
+# shard of the metadata rows, e.g. on computer 2 of 4:
+#
+#   python run_pipeline_tauimages.py run SampleList.xlsx --outputdir analysis_output --shard 2/4
+#
+# Each shard only extracts the statistics of its images, and saves them
+# in output_<analysis_ID>/shards/. When all shards are done,
+#
+#   python run_pipeline_tauimages.py merge SampleList.xlsx --outputdir analysis_output
+#
+# combines them, and runs the remaining stages (differences, save, plots).
+#
+# Run "python run_pipeline_tauimages.py run --help" to see all options.
+
+########################################################################
+# Libraries
+
+import os
+import sys
+import argparse
+
+LIBSCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(LIBSCRIPT_DIR)
+import lib_pipeline_tauimages_getstats as taustats
+
+ALL_STAGES = ['extract', 'differences', 'save', 'plots']
+
+########################################################################
+# Running the stages
+
+def parse_shard(shard_text):
+    # Convert "i/N" to (i, N)
+
+    try:
+        shard_number, nr_shards = [int(number) for number in shard_text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard should be given as i/N, e.g. 2/4')
+    if not 1 <= shard_number <= nr_shards:
+        raise argparse.ArgumentTypeError('shard i/N should have 1 <= i <= N')
+
+    return shard_number, nr_shards
+
+def parse_stages(stages_text):
+    # Convert e.g. "extract,save" to ['extract', 'save']
+
+    stages = [stage.strip() for stage in stages_text.split(',') if stage.strip() != '']
+    unknown_stages = [stage for stage in stages if stage not in ALL_STAGES]
+    if len(unknown_stages) > 0:
+        raise argparse.ArgumentTypeError('unknown stages ' + ', '.join(unknown_stages) +
+                                         ' (choose from ' + ', '.join(ALL_STAGES) + ')')
+
+    return stages
+
+def save_results(df_sample_data, path_outputdir, output_format):
+    # Save the dataframe as parquet and/or excel file
+
+    if output_format == 'excel':
+        taustats.save_dataframe_to_excel(df_sample_data, path_outputdir)
+    else:
+        taustats.save_dataframe(df_sample_data, path_outputdir, excel=(output_format == 'both'))
+
+    return None
+
+def run_remaining_stages(df_sample_data, args, stages, profile):
+    # Run the stages after extraction (differences, save, plots)
+
+    if 'differences' in stages:
+        with taustats.profile_stage(profile, 'stage', 'calculate_differences'):
+            df_sample_data = taustats.calculate_differences(df_sample_data)
+
+    if 'save' in stages:
+        with taustats.profile_stage(profile, 'stage', 'save_dataframe'):
+            save_results(df_sample_data, args.outputdir, args.format)
+
+    if 'plots' in stages:
+        import matplotlib
+        matplotlib.use('Agg') # no windows when running from the command line
+        errors = taustats.render_all_plots(df_sample_data, args.outputdir, n_workers=args.jobs, profile=profile)
+        if len(errors) > 0:
+            print(len(errors), 'plots failed')
+
+    return df_sample_data
+
+def command_run(args):
+
+    stages = args.stages
+    profile = taustats.new_run_profile() if args.profile else None
+    df_sample_metadata, df_sample_data = taustats.initialize_analysis(args.metadata)
+    analysis_ID = str(df_sample_data['Analysis_ID'].dropna().iloc[0])
+
+    if args.shard is not None:
+        # a shard only extracts the statistics of its part of the images
+        if stages != ALL_STAGES and stages != ['extract']:
+            sys.exit('With --shard, only the extract stage can be run; use the merge command for the other stages.')
+        shard_number, nr_shards = args.shard
+        df_sample_data = taustats.select_shard(df_sample_data, shard_number, nr_shards).copy()
+        print('Shard', shard_number, 'of', nr_shards, '(' + str(len(df_sample_data)) + ' images)')
+
+    if 'extract' in stages:
+        extraction_options = {'n_workers': args.jobs, 'masking': args.masking, 'uncertainty': args.uncertainty,
+                              'uniformity_grid': args.uniformity_grid, 'prefetch': args.prefetch, 'preview': args.preview,
+                              'profile': profile}
+        if args.cache:
+            extraction_options['path_cache'] = taustats.get_stats_cache_path(args.outputdir)
+        if args.journal or args.resume:
+            name_suffix = '' if args.shard is None else '__shard_' + str(args.shard[0]) + '_of_' + str(args.shard[1])
+            extraction_options['path_journal'] = taustats.get_journal_path(args.outputdir, analysis_ID, name_suffix)
+            extraction_options['resume'] = args.resume
+        df_sample_data = taustats.extract_means_and_medians(df_sample_data, **extraction_options)
+    else:
+        df_sample_data = taustats.load_dataframe(args.outputdir, analysis_ID)
+
+    if args.shard is not None:
+        taustats.save_shard(df_sample_data, args.outputdir, analysis_ID, *args.shard)
+    else:
+        if 'extract' in stages and 'save' not in stages:
+            # don't throw away the extracted statistics
+            taustats.save_dataframe(df_sample_data, args.outputdir, excel=False)
+        run_remaining_stages(df_sample_data, args, stages, profile)
+
+    if profile is not None:
+        taustats.save_run_profile(profile, args.outputdir, analysis_ID)
+
+    return None
+
+def command_merge(args):
+
+    profile = taustats.new_run_profile() if args.profile else None
+    _, df_sample_data_expected = taustats.initialize_analysis(args.metadata)
+    analysis_ID = str(df_sample_data_expected['Analysis_ID'].dropna().iloc[0])
+
+    df_sample_data = taustats.merge_shards(args.outputdir, analysis_ID)
+    if len(df_sample_data) != len(df_sample_data_expected):
+        sys.exit('The shards hold ' + str(len(df_sample_data)) + ' rows, but ' +
+                 str(len(df_sample_data_expected)) + ' samples were expected from the metadata file.')
+
+    run_remaining_stages(df_sample_data, args, [stage for stage in args.stages if stage != 'extract'], profile)
+
+    if profile is not None:
+        taustats.save_run_profile(profile, args.outputdir, analysis_ID)
+
+    return None
+
+########################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Extract arrival times and intensities from uniform FLIM images.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Options shared by both commands
+    shared_parser = argparse.ArgumentParser(add_help=False)
+    shared_parser.add_argument('metadata', help='metadata excel file (e.g. SampleList.xlsx)')
+    shared_parser.add_argument('--outputdir', required=True, help='directory in which output_<Analysis_ID> is created')
+    shared_parser.add_argument('--jobs', type=int, default=1, help='number of processes (default: 1; 0 uses all cores)')
+    shared_parser.add_argument('--stages', type=parse_stages, default=ALL_STAGES,
+                               help='comma-separated stages to run (default: ' + ','.join(ALL_STAGES) + ')')
+    shared_parser.add_argument('--format', choices=['parquet', 'excel', 'both'], default='both',
+                               help='format in which the results are saved (default: both)')
+    shared_parser.add_argument('--profile', action='store_true', help='save a run profile with timings')
+
+    run_parser = subparsers.add_parser('run', parents=[shared_parser], help='run the pipeline (or one shard of it)')
+    run_parser.add_argument('--shard', type=parse_shard, default=None,
+                            help='only extract the statistics of shard i of N (given as i/N), see the merge command')
+    run_parser.add_argument('--cache', action='store_true', help='skip images that were analyzed before (see get_stats_cache_path)')
+    run_parser.add_argument('--journal', action='store_true', help='write the results of each image to a journal as soon as they are known')
+    run_parser.add_argument('--resume', action='store_true', help='continue a run that was stopped, using its journal')
+    run_parser.add_argument('--masking', choices=['dorus'], default=None, help='only use pixels with sufficient intensity')
+    run_parser.add_argument('--uncertainty', choices=['bootstrap', 'block_bootstrap'], default=None,
+                            help='add standard errors and confidence intervals')
+    run_parser.add_argument('--uniformity-grid', type=int, default=None, help='check uniformity on a grid of this size (e.g. 8)')
+    run_parser.add_argument('--prefetch', type=int, default=0, help='number of files to read ahead (with --jobs 1)')
+    run_parser.add_argument('--preview', type=int, default=None,
+                            help='quick estimate from every n-th pixel of every n-th row (e.g. 4), with error bounds')
+
+    subparsers.add_parser('merge', parents=[shared_parser], help='combine the shards, and run the remaining stages')
+
+    args = parser.parse_args()
+    if args.jobs == 0:
+        args.jobs = None
+
+    if args.command == 'run':
+        command_run(args)
+    else:
+        command_merge(args)